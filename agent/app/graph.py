@@ -1,41 +1,14 @@
-import json
+import heapq
 import re
-from typing import TypedDict, List, Dict, Any, Optional
+from itertools import chain, islice
+from typing import TypedDict, List, Dict, Any, Optional, Iterable, Iterator
 
 from langgraph.graph import StateGraph, END
 
-from agent.app.prompt import build_prompt
+from agent.app.prompt import SYSTEM_PROMPT, build_prompt
 from agent.app.llm_provider import generate
 from agent.app.verify import validate_evidence
-
-# --- Intent detection (router) ---
-PAGE_RE = re.compile(r"\b(?:page|p\.?|sayfa)\s*#?\s*(\d{1,3})\b", re.IGNORECASE)
-VISUAL_INTENT_RE = re.compile(
-    r"\b(diagram|figure|table|chart|flowchart|illustration|şekil|tablo)\b",
-    re.IGNORECASE,
-)
-
-# Object-related intent (TR+EN)
-OBJ_INTENT_RE = re.compile(
-    r"\b(object|objects|session|object_list|layer|katman|type|tip|polyline|line|window|windows|highway|kaç|adet|nesne|obje|var mı|mevcut mu|bulunuyor mu)\b",
-    re.IGNORECASE,
-)
-
-# YES/NO / presence intent
-YESNO_INTENT_RE = re.compile(
-    r"\b(yes\/no|yes or no|reply with only (yes|no)|answer (yes|no)|evet\/hayir|evet mi hayir mi)\b",
-    re.IGNORECASE,
-)
-PRESENCE_INTENT_RE = re.compile(
-    r"\b(do i have|any object on|have any object|is there any|var mı|mevcut mu|bulunuyor mu)\b",
-    re.IGNORECASE,
-)
-
-# Doc-span intent: user asking "what does page X explain", "what is the restriction", "measure", etc.
-DOC_RULE_INTENT_RE = re.compile(
-    r"\b(explain|restriction|means|rule|measured|measure|how to|what is|define|definition|nedir|açıkla|tanım|ölç|kural|kısıt)\b",
-    re.IGNORECASE,
-)
+from agent.app.utils import asked_page_from_intents, clean_ws, parse_llm_json, scan_intents
 
 # Extract explicit layer/type targets from question (dynamic mapping)
 # Case 1: "layer Windows" / "katman Highway"
@@ -51,14 +24,37 @@ TYPE_TARGET_RE = re.compile(
     r"\b(?:type|tip)\s*[:=]?\s*([A-Za-z0-9_\-]{2,30})\b", re.IGNORECASE
 )
 
+# type-count fallback: "line" as a whole word (not "polyline"/"outline")
+LINE_WORD_RE = re.compile(r"\bline\b")
+
+RESTRICTION_RE = re.compile(r"this restriction means[^.]*\.?", re.IGNORECASE)
+
+# layer keywords checked by node_object_verify ("windows" is covered by "window")
+LAYER_MENTION_RE = re.compile(r"highway|window")
+
+
+def _layer_mentions(*texts: str) -> set:
+    """Which of LAYER_MENTION_RE's keywords occur in the (lowercased) texts, one scan each."""
+    found: set = set()
+    for t in texts:
+        for m in LAYER_MENTION_RE.finditer(t):
+            found.add(m.group(0))
+            if len(found) == 2:
+                return found
+    return found
+
 
 class GraphState(TypedDict, total=False):
     question: str
     object_summary: Dict[str, Any]
     object_list: List[Dict[str, Any]]
+    # lowercased by_layer/by_type views (see build_object_index)
+    object_index: Dict[str, Dict[str, Any]]
     hits: List[Dict[str, Any]]
 
     # Router outputs
+    intents: Dict[str, Any]
+    query_intent: Any
     plan: Dict[str, Any]
     filtered_hits: List[Dict[str, Any]]
     short_circuit: bool
@@ -82,33 +78,18 @@ class GraphState(TypedDict, total=False):
     used_hits: List[Dict[str, Any]]
 
 
-def _extract_json_block(s: str) -> str:
-    s = (s or "").strip()
-    i = s.find("{")
-    j = s.rfind("}")
-    if i == -1 or j == -1 or j <= i:
-        return s
-    return s[i : j + 1]
-
-
-def _asked_page(question: str) -> Optional[int]:
-    m = PAGE_RE.search(question or "")
-    if not m:
-        return None
-    try:
-        p = int(m.group(1))
-        if 1 <= p <= 999:
-            return p
-    except Exception:
-        return None
-    return None
-
-
-def _is_visual(question: str) -> bool:
-    return VISUAL_INTENT_RE.search(question or "") is not None
+def _md(h: Dict[str, Any]) -> Dict[str, Any]:
+    # main.py caches the metadata dict as "_md" (see _annotate_hits)
+    md = h.get("_md")
+    if md is None:
+        md = h.get("metadata") or {}
+    return md
 
 
 def _score(h: Dict[str, Any]) -> float:
+    cached = h.get("_score_f")
+    if cached is not None:
+        return cached
     s = h.get("score")
     try:
         return float(s) if s is not None else -1.0
@@ -116,8 +97,25 @@ def _score(h: Dict[str, Any]) -> float:
         return -1.0
 
 
-def _clean_ws(s: str) -> str:
-    return " ".join((s or "").replace("\n", " ").split()).strip()
+def build_object_index(object_summary: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """
+    Case-insensitive lookup tables for by_layer/by_type, built once per request.
+    First key wins on case collisions (same as the old linear scan).
+    """
+    index: Dict[str, Dict[str, Any]] = {}
+    for name in ("by_layer", "by_type"):
+        lc: Dict[str, Any] = {}
+        for k, v in (object_summary.get(name) or {}).items():
+            lc.setdefault(str(k).lower(), v)
+        index[name] = lc
+    return index
+
+
+def _object_index(state: GraphState) -> Dict[str, Dict[str, Any]]:
+    index = state.get("object_index")
+    if index is None:
+        index = build_object_index(state.get("object_summary") or {})
+    return index
 
 
 def _extract_layer_target(q: str) -> Optional[str]:
@@ -134,7 +132,7 @@ def _extract_layer_target(q: str) -> Optional[str]:
     if not m:
         return None
 
-    name = _clean_ws(m.group(1))
+    name = clean_ws(m.group(1))
     # trim trailing common words
     name = re.sub(r"\b(objects|objeler|count|kaç|adet)\b$", "", name, flags=re.IGNORECASE).strip()
     # remove stray quotes if any
@@ -146,96 +144,35 @@ def _extract_type_target(q: str) -> Optional[str]:
     m = TYPE_TARGET_RE.search(q or "")
     if not m:
         return None
-    name = _clean_ws(m.group(1))
+    name = clean_ws(m.group(1))
     return name or None
 
 
-def node_router(state: GraphState) -> GraphState:
+def build_plan(question: str, intents: Dict[str, Any], has_caption: bool) -> Dict[str, Any]:
     """
-    Routing plan:
-    - visual intent => need caption; if no caption => short_circuit
-    - non-visual => text
-    Also decides "direct_*" strategies (object count/layer/type, direct doc span).
+    Strategy + targets for a question (the router's plan). Only needs the intents
+    and whether a caption hit exists, so main.py can also use it before retrieval.
     """
-    q = (state.get("question", "") or "").strip()
+    q = (question or "").strip()
     ql = q.lower()
-    hits = state.get("hits", []) or []
-
-    visual = _is_visual(q)
-    asked_page = _asked_page(q)
-
-    caps: List[Dict[str, Any]] = []
-    txts: List[Dict[str, Any]] = []
-
-    for h in hits:
-        md = h.get("metadata") or {}
-        if md.get("kind") == "caption":
-            caps.append(h)
-        else:
-            txts.append(h)
-
-    caps.sort(key=_score, reverse=True)
-    txts.sort(key=_score, reverse=True)
-
-    short_circuit = False
-    filtered: List[Dict[str, Any]] = []
-
-    if visual:
-        if not caps:
-            short_circuit = True
-            filtered = hits[:]
-        else:
-            best_cap = None
-            if asked_page is not None:
-                for c in caps:
-                    if (c.get("metadata") or {}).get("page") == asked_page:
-                        best_cap = c
-                        break
-            if best_cap is None:
-                best_cap = caps[0]
-
-            filtered.append(best_cap)
-
-            cap_page = (best_cap.get("metadata") or {}).get("page")
-            best_txt = None
-            for t in txts:
-                if (t.get("metadata") or {}).get("page") == cap_page:
-                    best_txt = t
-                    break
-            if best_txt:
-                filtered.append(best_txt)
-            elif txts:
-                filtered.append(txts[0])
-
-            seen = {h.get("chunk_id") for h in filtered}
-            pool = [*caps, *txts]
-            pool.sort(key=_score, reverse=True)
-            for h in pool:
-                cid = h.get("chunk_id")
-                if cid in seen:
-                    continue
-                filtered.append(h)
-                seen.add(cid)
-                if len(filtered) >= 5:
-                    break
-    else:
-        filtered = (txts[:5] if txts else hits[:5])
+    visual = "visual" in intents
+    asked_page = asked_page_from_intents(intents)
 
     # ---- Decide baseline strategy ----
-    strategy = "caption+text" if visual and caps else ("text_only" if not visual else "visual_no_caption_shortcircuit")
+    strategy = "caption+text" if visual and has_caption else ("text_only" if not visual else "visual_no_caption_shortcircuit")
 
     # compute dynamic targets once, store in plan
     layer_target = _extract_layer_target(q)
     type_target = _extract_type_target(q)
 
     # intent flags
-    is_obj_intent = OBJ_INTENT_RE.search(q) is not None
-    is_doc_rule_intent = DOC_RULE_INTENT_RE.search(q) is not None
-    wants_yesno = (YESNO_INTENT_RE.search(q) is not None) or ("yes/no" in ql)
-    wants_presence = PRESENCE_INTENT_RE.search(q) is not None
+    is_obj_intent = "obj" in intents
+    is_doc_rule_intent = "doc" in intents
+    wants_yesno = ("yesno" in intents) or ("yes/no" in ql)
+    wants_presence = "presence" in intents
 
     # --- Direct object answering: counts ---
-    if re.search(r"\bhow many\b|\bkaç\b|\badet\b", ql) and is_obj_intent:
+    if "count" in intents and is_obj_intent:
         if layer_target is not None:
             strategy = "direct_object_layer_count"
         elif type_target is not None:
@@ -244,7 +181,7 @@ def node_router(state: GraphState) -> GraphState:
             # fallback heuristics
             if ("window" in ql or "windows" in ql or "pencere" in ql) or ("highway" in ql):
                 strategy = "direct_object_layer_count"
-            elif ("polyline" in ql or re.search(r"\bline\b", ql)):
+            elif ("polyline" in ql or LINE_WORD_RE.search(ql)):
                 strategy = "direct_object_type_count"
             else:
                 strategy = "direct_object_count"
@@ -253,12 +190,6 @@ def node_router(state: GraphState) -> GraphState:
     # Example:
     # "Using page 14 rule AND my session objects: do I have any object on the 'Highway' layer? Answer YES/NO + quote from page 14."
     if (asked_page is not None) and is_obj_intent and is_doc_rule_intent and (wants_yesno or wants_presence):
-        # if layer target wasn't extracted, use a small heuristic:
-        if layer_target is None:
-            if "highway" in ql:
-                layer_target = "Highway"
-            elif "window" in ql or "windows" in ql:
-                layer_target = "Windows"
         strategy = "direct_object_layer_presence_with_doc_quote"
 
     # Direct doc span when page+rule signal is strong
@@ -266,16 +197,107 @@ def node_router(state: GraphState) -> GraphState:
     if strategy == "text_only" and asked_page is not None and is_doc_rule_intent and (not is_obj_intent):
         strategy = "direct_doc_span"
 
+    # If no target was extracted, fill it with a small heuristic so the plan is final
+    # and node_direct_answer can use it as-is.
+    if strategy == "direct_object_layer_count" and layer_target is None:
+        if "window" in ql or "windows" in ql or "pencere" in ql:
+            layer_target = "Windows"
+        elif "highway" in ql:
+            layer_target = "Highway"
+    elif strategy == "direct_object_layer_presence_with_doc_quote" and layer_target is None:
+        if "highway" in ql:
+            layer_target = "Highway"
+        elif "window" in ql or "windows" in ql:
+            layer_target = "Windows"
+    elif strategy == "direct_object_type_count" and type_target is None:
+        if "polyline" in ql:
+            type_target = "POLYLINE"
+        elif LINE_WORD_RE.search(ql):
+            type_target = "LINE"
+
     plan = {
         "visual_intent": visual,
         "asked_page": asked_page,
-        "has_caption": bool(caps),
+        "has_caption": has_caption,
         "strategy": strategy,
         "layer_target": layer_target,
         "type_target": type_target,
     }
+    return plan
 
-    return {"plan": plan, "filtered_hits": filtered, "short_circuit": short_circuit}
+
+def _unseen(hits: Iterable[Dict[str, Any]], seen: set) -> Iterator[Dict[str, Any]]:
+    """Yield hits whose chunk_id isn't in `seen` yet (and mark them seen)."""
+    for h in hits:
+        cid = h.get("chunk_id")
+        if cid not in seen:
+            seen.add(cid)
+            yield h
+
+
+def node_router(state: GraphState) -> GraphState:
+    """
+    Routing plan:
+    - visual intent => need caption; if no caption => short_circuit
+    - non-visual => text
+    Also decides "direct_*" strategies (object count/layer/type, direct doc span) via build_plan.
+    """
+    q = (state.get("question", "") or "").strip()
+    hits = state.get("hits", []) or []
+
+    # main.py scans the question once and passes the intents along
+    intents = state.get("intents")
+    if intents is None:
+        intents = scan_intents(q)
+    visual = "visual" in intents
+    asked_page = asked_page_from_intents(intents)
+
+    caps: List[Dict[str, Any]] = []
+    txts: List[Dict[str, Any]] = []
+
+    for h in hits:
+        if _md(h).get("kind") == "caption":
+            caps.append(h)
+        else:
+            txts.append(h)
+
+    short_circuit = False
+    filtered: List[Dict[str, Any]] = []
+
+    # Only a handful of hits are ever kept: pick them with max()/nlargest()
+    # instead of fully sorting caps, txts and the merged pool.
+    if visual:
+        if not caps:
+            short_circuit = True
+            # not mutated downstream, share the list
+            filtered = hits
+        else:
+            best_cap = None
+            if asked_page is not None:
+                best_cap = max((c for c in caps if _md(c).get("page") == asked_page), key=_score, default=None)
+            if best_cap is None:
+                best_cap = max(caps, key=_score)
+
+            filtered.append(best_cap)
+
+            cap_page = _md(best_cap).get("page")
+            best_txt = max((t for t in txts if _md(t).get("page") == cap_page), key=_score, default=None)
+            if best_txt is None and txts:
+                best_txt = max(txts, key=_score)
+            if best_txt is not None:
+                filtered.append(best_txt)
+
+            seen = {h.get("chunk_id") for h in filtered}
+            # chunk_ids are unique per retrieval, so at most len(filtered) of the
+            # top entries are already picked
+            pool = heapq.nlargest(5 + len(filtered), chain(caps, txts), key=_score)
+            filtered.extend(islice(_unseen(pool, seen), 5 - len(filtered)))
+    else:
+        filtered = (heapq.nlargest(5, txts, key=_score) if txts else hits[:5])
+
+    plan = build_plan(q, intents, has_caption=bool(caps))
+
+    return {"intents": intents, "plan": plan, "filtered_hits": filtered, "short_circuit": short_circuit}
 
 
 def _safe_int(x, default=0) -> int:
@@ -295,8 +317,7 @@ def node_object_verify(state: GraphState) -> GraphState:
     checks: List[Dict[str, Any]] = []
 
     total = _safe_int(summ.get("total_objects", 0), 0)
-    by_layer = summ.get("by_layer") or {}
-    by_type = summ.get("by_type") or {}
+    layers_lc = _object_index(state)["by_layer"]
 
     if len(obj_list) != total:
         checks.append({
@@ -305,7 +326,10 @@ def node_object_verify(state: GraphState) -> GraphState:
             "message": f"object_summary.total_objects={total} but object_list has {len(obj_list)} items.",
         })
 
-    if OBJ_INTENT_RE.search(q) and len(obj_list) == 0:
+    intents = state.get("intents")
+    if intents is None:
+        intents = scan_intents(q)
+    if ("obj" in intents) and len(obj_list) == 0:
         checks.append({
             "level": "warning",
             "code": "NO_OBJECTS_IN_SESSION",
@@ -331,18 +355,21 @@ def node_object_verify(state: GraphState) -> GraphState:
         })
 
     # context-aware missing layer checks (only warn if doc or question mentions)
-    ht = _clean_ws(" ".join([(h.get("text") or "") for h in hits])).lower()
+    # plain substring tests: whitespace normalization doesn't matter, reuse cached lowercased text
+    ht = " ".join(h.get("_text_lc") or (h.get("text") or "").lower() for h in hits)
+
+    mentioned = _layer_mentions(ql, ht)
 
-    if ("highway" in ql) or ("highway" in ht):
-        if not any(k.lower() == "highway" for k in by_layer.keys()):
+    if "highway" in mentioned:
+        if "highway" not in layers_lc:
             checks.append({
                 "level": "warning",
                 "code": "LAYER_MISSING_HIGHWAY",
                 "message": "Doc/question mentions 'highway' but object_list has no 'Highway' layer objects.",
             })
 
-    if ("window" in ql) or ("windows" in ql) or ("window" in ht) or ("windows" in ht):
-        if not any("window" in k.lower() for k in by_layer.keys()):
+    if "window" in mentioned:
+        if not any("window" in k for k in layers_lc):
             checks.append({
                 "level": "warning",
                 "code": "LAYER_MISSING_WINDOWS",
@@ -354,14 +381,14 @@ def node_object_verify(state: GraphState) -> GraphState:
 
 def _best_text_hit(hits: List[Dict[str, Any]], asked_page: Optional[int]) -> Optional[Dict[str, Any]]:
     # prefer text on asked page
-    for h in hits:
-        md = h.get("metadata") or {}
-        if md.get("kind") == "text" and asked_page is not None and md.get("page") == asked_page:
-            return h
+    if asked_page is not None:
+        for h in hits:
+            md = _md(h)
+            if md.get("kind") == "text" and md.get("page") == asked_page:
+                return h
     # otherwise best text
     for h in hits:
-        md = h.get("metadata") or {}
-        if md.get("kind") == "text":
+        if _md(h).get("kind") == "text":
             return h
     return None
 
@@ -371,22 +398,20 @@ def _extract_restriction_sentence(excerpt: str) -> Optional[str]:
     Try to pull a clean sentence starting at 'This restriction means ...'
     Works even if PDF text is single-line.
     """
-    ex = _clean_ws(excerpt)
+    ex = clean_ws(excerpt)
     if not ex:
         return None
 
-    idx = ex.lower().find("this restriction means")
-    if idx == -1:
+    # one case-insensitive search: phrase + everything up to (and incl.) the first period
+    m = RESTRICTION_RE.search(ex)
+    if not m:
         return None
 
-    tail = ex[idx:]
-    m = re.search(r"\.", tail)
-    if m:
-        sent = tail[: m.start() + 1]
-    else:
-        sent = tail[:240]
+    sent = m.group(0)
+    if not sent.endswith("."):
+        sent = sent[:240]
 
-    sent = _clean_ws(sent)
+    sent = clean_ws(sent)
     if len(sent) < 20:
         return None
     return sent
@@ -401,12 +426,9 @@ def node_direct_answer(state: GraphState) -> GraphState:
     """
     plan = state.get("plan") or {}
     strategy = (plan.get("strategy") or "").strip()
-    q = (state.get("question", "") or "").strip()
-    ql = q.lower()
 
     summ = state.get("object_summary") or {}
-    by_layer = summ.get("by_layer") or {}
-    by_type = summ.get("by_type") or {}
+    index = _object_index(state)
 
     hits = state.get("filtered_hits") or state.get("hits") or []
 
@@ -417,73 +439,33 @@ def node_direct_answer(state: GraphState) -> GraphState:
             "direct_answer": str(n),
             "direct_evidence": [],
             "used_hits": hits,
-            "plan": {**plan, "strategy": "direct_object_count"},
         }
 
     if strategy == "direct_object_layer_count":
-        layer_target = (plan.get("layer_target") or "").strip() or None
-
-        # fallback heuristics
-        if layer_target is None:
-            if "window" in ql or "windows" in ql or "pencere" in ql:
-                layer_target = "Windows"
-            elif "highway" in ql:
-                layer_target = "Highway"
-
-        count = 0
-        if layer_target:
-            for k, v in by_layer.items():
-                if str(k).lower() == layer_target.lower():
-                    count = _safe_int(v, 0)
-                    break
+        layer_target = plan.get("layer_target")
+        count = _safe_int(index["by_layer"].get(layer_target.lower(), 0), 0) if layer_target else 0
 
         return {
             "direct_answer": str(count),
             "direct_evidence": [],
             "used_hits": hits,
-            "plan": {**plan, "strategy": "direct_object_layer_count", "layer_target": layer_target},
         }
 
     if strategy == "direct_object_type_count":
-        type_target = (plan.get("type_target") or "").strip() or None
-
-        if type_target is None:
-            if "polyline" in ql:
-                type_target = "POLYLINE"
-            elif re.search(r"\bline\b", ql):
-                type_target = "LINE"
-
-        count = 0
-        if type_target:
-            for k, v in by_type.items():
-                if str(k).lower() == type_target.lower():
-                    count = _safe_int(v, 0)
-                    break
+        type_target = plan.get("type_target")
+        count = _safe_int(index["by_type"].get(type_target.lower(), 0), 0) if type_target else 0
 
         return {
             "direct_answer": str(count),
             "direct_evidence": [],
             "used_hits": hits,
-            "plan": {**plan, "strategy": "direct_object_type_count", "type_target": type_target},
         }
 
     # ✅ NEW: direct YES/NO layer presence + quote from asked page
     if strategy == "direct_object_layer_presence_with_doc_quote":
         asked_page = plan.get("asked_page")
-        layer_target = (plan.get("layer_target") or "").strip() or None
-
-        if layer_target is None:
-            if "highway" in ql:
-                layer_target = "Highway"
-            elif "window" in ql or "windows" in ql:
-                layer_target = "Windows"
-
-        count = 0
-        if layer_target:
-            for k, v in by_layer.items():
-                if str(k).lower() == layer_target.lower():
-                    count = _safe_int(v, 0)
-                    break
+        layer_target = plan.get("layer_target")
+        count = _safe_int(index["by_layer"].get(layer_target.lower(), 0), 0) if layer_target else 0
 
         yesno = "YES" if count > 0 else "NO"
 
@@ -492,7 +474,7 @@ def node_direct_answer(state: GraphState) -> GraphState:
         used_hits = hits
         if best:
             chunk_id = best.get("chunk_id")
-            excerpt = _clean_ws(best.get("text") or "")
+            excerpt = clean_ws(best.get("text") or "")
             restr = _extract_restriction_sentence(excerpt)
             quote = (restr or excerpt)[:180] if (restr or excerpt) else ""
             evidence = [{"source_id": 1, "chunk_id": chunk_id, "quote": quote}]
@@ -502,7 +484,6 @@ def node_direct_answer(state: GraphState) -> GraphState:
             "direct_answer": yesno,  # IMPORTANT: only YES/NO
             "direct_evidence": evidence,
             "used_hits": used_hits,
-            "plan": {**plan, "strategy": "direct_object_layer_presence_with_doc_quote", "layer_target": layer_target},
         }
 
     # --- direct doc span ---
@@ -513,7 +494,7 @@ def node_direct_answer(state: GraphState) -> GraphState:
             return {}
 
         chunk_id = best.get("chunk_id")
-        excerpt = _clean_ws(best.get("text") or "")
+        excerpt = clean_ws(best.get("text") or "")
 
         restr = _extract_restriction_sentence(excerpt)
         if restr:
@@ -534,20 +515,31 @@ def node_direct_answer(state: GraphState) -> GraphState:
             "direct_answer": ans,
             "direct_evidence": [{"source_id": 1, "chunk_id": chunk_id, "quote": quote}],
             "used_hits": [best],
-            "plan": {**plan, "strategy": "direct_doc_span"},
         }
 
     return {}
 
 
-def node_draft(state: GraphState) -> GraphState:
-    # If direct_answer already computed, skip LLM
+async def node_draft(state: GraphState) -> GraphState:
+    # If direct_answer already computed, skip LLM and validate the structured payload
+    # here (no JSON round-trip); the graph then ends right after this node.
     if state.get("direct_answer") is not None:
         payload = {
             "answer": state.get("direct_answer") or "I don't have enough information in the provided excerpts.",
             "evidence": state.get("direct_evidence") or [],
         }
-        return {"raw": json.dumps(payload)}
+        hits = state.get("filtered_hits") or state.get("hits", []) or []
+        try:
+            payload = validate_evidence(
+                payload, state.get("used_hits") or hits, state.get("question"), state.get("query_intent")
+            )
+        except Exception:
+            payload = {"answer": "I don't have enough information in the provided excerpts.", "evidence": []}
+        # direct_* strategies do NOT require evidence
+        return {
+            "answer": payload.get("answer") or "I don't have enough information in the provided excerpts.",
+            "evidence": payload.get("evidence") or [],
+        }
 
     hits = state.get("filtered_hits") or state.get("hits", []) or []
 
@@ -558,34 +550,33 @@ def node_draft(state: GraphState) -> GraphState:
         state.get("question", ""),
         state.get("object_summary") or {},
         hits,
+        state.get("query_intent"),
     )
-    raw = generate(prompt)
+    raw = await generate(prompt, system=SYSTEM_PROMPT)
     return {"raw": raw}
 
 
 def node_parse_and_validate(state: GraphState) -> GraphState:
     hits = state.get("filtered_hits") or state.get("hits", []) or []
     raw = state.get("raw", "")
-    candidate = _extract_json_block(raw)
-
     plan = state.get("plan") or {}
     strategy = (plan.get("strategy") or "").strip()
     used_hits = state.get("used_hits") or hits
 
+    # Return only the keys this node changes: plan/object_checks are already in the
+    # state, and used_hits only needs writing when no earlier node pinned it.
+    out: GraphState = {} if state.get("used_hits") else {"used_hits": used_hits}
+
     try:
-        parsed = json.loads(candidate)
+        parsed = parse_llm_json(raw)
     except Exception:
-        return {
-            "answer": "I don't have enough information in the provided excerpts.",
-            "evidence": [],
-            "object_checks": state.get("object_checks", []) or [],
-            "plan": plan,
-            "used_hits": used_hits,
-        }
+        out["answer"] = "I don't have enough information in the provided excerpts."
+        out["evidence"] = []
+        return out
 
     # Validate evidence against the SAME hits used for SOURCE numbering
     try:
-        parsed = validate_evidence(parsed, used_hits, state.get("question"))
+        parsed = validate_evidence(parsed, used_hits, state.get("question"), state.get("query_intent"))
     except Exception:
         parsed = {"answer": "I don't have enough information in the provided excerpts.", "evidence": []}
 
@@ -597,19 +588,22 @@ def node_parse_and_validate(state: GraphState) -> GraphState:
         answer = "I don't have enough information in the provided excerpts."
         evidence = []
 
-    return {
-        "answer": answer,
-        "evidence": evidence,
-        "object_checks": state.get("object_checks", []) or [],
-        "plan": plan,
-        "used_hits": used_hits,
-    }
+    out["answer"] = answer
+    out["evidence"] = evidence
+    return out
 
 
 def node_retry(state: GraphState) -> GraphState:
     return {"retry_count": state.get("retry_count", 0) + 1}
 
 
+def after_draft(state: GraphState) -> str:
+    # direct answers are already final (see node_draft)
+    if state.get("direct_answer") is not None:
+        return "done"
+    return "validate"
+
+
 def should_retry(state: GraphState) -> str:
     evidence = state.get("evidence") or []
     retry_count = state.get("retry_count", 0)
@@ -643,7 +637,11 @@ def build_graph():
     g.add_edge("router", "object_verify")
     g.add_edge("object_verify", "direct")
     g.add_edge("direct", "draft")
-    g.add_edge("draft", "validate")
+    g.add_conditional_edges(
+        "draft",
+        after_draft,
+        {"validate": "validate", "done": END},
+    )
 
     g.add_conditional_edges(
         "validate",
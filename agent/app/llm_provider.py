@@ -1,37 +1,59 @@
 import os
+
 import httpx
+import orjson
 
 class LLMError(RuntimeError):
     pass
 
-_CLIENT: httpx.Client | None = None
+_CLIENT: httpx.AsyncClient | None = None
+
+def _http2_enabled() -> bool:
+    # Ollama is plain HTTP/1.1; HTTP/2 only pays off on TLS endpoints like OpenAI
+    provider = os.getenv("LLM_PROVIDER", "ollama").lower().strip()
+    default = "1" if provider == "openai" else "0"
+    return os.getenv("LLM_HTTP2", default).strip() == "1"
 
-def _client() -> httpx.Client:
+def _build_client() -> httpx.AsyncClient:
+    timeout = httpx.Timeout(
+        connect=float(os.getenv("LLM_CONNECT_TIMEOUT", "5")),
+        read=float(os.getenv("LLM_READ_TIMEOUT", "120")),
+        write=float(os.getenv("LLM_WRITE_TIMEOUT", "30")),
+        pool=float(os.getenv("LLM_POOL_TIMEOUT", "30")),
+    )
+    limits = httpx.Limits(
+        max_keepalive_connections=int(os.getenv("LLM_MAX_KEEPALIVE", "5")),
+        max_connections=int(os.getenv("LLM_MAX_CONNECTIONS", "10")),
+        keepalive_expiry=float(os.getenv("LLM_KEEPALIVE_EXPIRY", "30")),
+    )
+    return httpx.AsyncClient(timeout=timeout, limits=limits, http2=_http2_enabled())
+
+def _client() -> httpx.AsyncClient:
+    # only used from the event loop, so no locking is needed
     global _CLIENT
     if _CLIENT is None:
-        timeout = httpx.Timeout(
-            connect=float(os.getenv("LLM_CONNECT_TIMEOUT", "5")),
-            read=float(os.getenv("LLM_READ_TIMEOUT", "120")),
-            write=float(os.getenv("LLM_WRITE_TIMEOUT", "30")),
-            pool=float(os.getenv("LLM_POOL_TIMEOUT", "30")),
-        )
-        limits = httpx.Limits(
-            max_keepalive_connections=int(os.getenv("LLM_MAX_KEEPALIVE", "5")),
-            max_connections=int(os.getenv("LLM_MAX_CONNECTIONS", "10")),
-            keepalive_expiry=float(os.getenv("LLM_KEEPALIVE_EXPIRY", "30")),
-        )
-        _CLIENT = httpx.Client(timeout=timeout, limits=limits, http2=False)
+        _CLIENT = _build_client()
     return _CLIENT
 
-def generate(prompt: str) -> str:
+async def aclose_client() -> None:
+    global _CLIENT
+    if _CLIENT is not None:
+        await _CLIENT.aclose()
+        _CLIENT = None
+
+# build eagerly at import (main.py loads .env before importing us)
+_client()
+
+async def generate(prompt: str, system: str | None = None) -> str:
+    # system: static instructions kept apart from the per-request prompt
     provider = os.getenv("LLM_PROVIDER", "ollama").lower().strip()
     if provider == "ollama":
-        return _generate_ollama(prompt)
+        return await _generate_ollama(prompt, system)
     if provider == "openai":
-        return _generate_openai(prompt)
+        return await _generate_openai(prompt, system)
     raise LLMError(f"Unsupported LLM_PROVIDER={provider}")
 
-def _generate_ollama(prompt: str) -> str:
+async def _generate_ollama(prompt: str, system: str | None = None) -> str:
     base = os.getenv("OLLAMA_BASE_URL", "http://127.0.0.1:11434").rstrip("/")
     model = os.getenv("OLLAMA_MODEL", "llama3.1:8b")
     url = f"{base}/api/generate"
@@ -41,16 +63,24 @@ def _generate_ollama(prompt: str) -> str:
     top_p = float(os.getenv("OLLAMA_TOP_P", "0.9"))
     fmt = os.getenv("OLLAMA_FORMAT", "json").strip() or "json"
 
+    # stream by default so we can stop reading as soon as the JSON object closes
+    stream = os.getenv("OLLAMA_STREAM", "1").strip() == "1"
+
     payload = {
         "model": model,
         "prompt": prompt,
-        "stream": False,
+        "stream": stream,
         "format": fmt,
         "options": {"temperature": temperature, "num_predict": num_predict, "top_p": top_p},
     }
+    if system:
+        payload["system"] = system
+
+    if stream:
+        return await _generate_ollama_stream(url, payload)
 
     try:
-        r = _client().post(url, json=payload)
+        r = await _client().post(url, json=payload)
         r.raise_for_status()
         data = r.json()
     except Exception as e:
@@ -58,7 +88,70 @@ def _generate_ollama(prompt: str) -> str:
 
     return (data.get("response") or "").strip()
 
-def _generate_openai(prompt: str) -> str:
+class _JsonEndTracker:
+    """
+    Tracks brace depth over streamed text (ignoring braces inside JSON strings)
+    to tell when the top-level object has closed.
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.started = False
+        self.in_str = False
+        self.esc = False
+
+    def feed(self, piece: str) -> int | None:
+        """Return the index just past the closing brace in `piece`, or None."""
+        for i, ch in enumerate(piece):
+            if self.in_str:
+                if self.esc:
+                    self.esc = False
+                elif ch == "\\":
+                    self.esc = True
+                elif ch == '"':
+                    self.in_str = False
+            elif ch == '"':
+                if self.started:
+                    self.in_str = True
+            elif ch == "{":
+                self.depth += 1
+                self.started = True
+            elif ch == "}" and self.started:
+                self.depth -= 1
+                if self.depth == 0:
+                    return i + 1
+        return None
+
+async def _generate_ollama_stream(url: str, payload: dict) -> str:
+    parts: list[str] = []
+    tracker = _JsonEndTracker()
+    try:
+        # Trade-off: leaving the block before Ollama's final line closes the pooled
+        # connection (httpx can't reuse a half-read response), and that close is what
+        # stops generation. Tokens after the closing brace (format=json tends to pad
+        # with whitespace up to num_predict) cost far more than a fresh TCP connect
+        # (~0.6 ms on loopback), so the early exit wins. A reply that runs to "done"
+        # is read to the end and its connection stays in the pool.
+        async with _client().stream("POST", url, json=payload) as r:
+            r.raise_for_status()
+            async for line in r.aiter_lines():
+                if not line:
+                    continue
+                chunk = orjson.loads(line)
+                if chunk.get("error"):
+                    raise LLMError(chunk["error"])
+                piece = chunk.get("response") or ""
+                end = tracker.feed(piece)
+                if end is not None:
+                    parts.append(piece[:end])
+                    break
+                parts.append(piece)
+    except Exception as e:
+        raise LLMError(f"Ollama request failed: {e}") from e
+
+    return "".join(parts).strip()
+
+async def _generate_openai(prompt: str, system: str | None = None) -> str:
     api_key = os.getenv("OPENAI_API_KEY", "").strip()
     if not api_key:
         raise LLMError("OPENAI_API_KEY is not set")
@@ -80,13 +173,13 @@ def _generate_openai(prompt: str) -> str:
         "temperature": temperature,
         "max_tokens": max_tokens,
         "messages": [
-            {"role": "system", "content": "Return ONLY valid JSON as instructed."},
+            {"role": "system", "content": system or "Return ONLY valid JSON as instructed."},
             {"role": "user", "content": prompt},
         ],
     }
 
     try:
-        r = _client().post(url, headers=headers, json=payload)
+        r = await _client().post(url, headers=headers, json=payload)
         r.raise_for_status()
         data = r.json()
         return (data["choices"][0]["message"]["content"] or "").strip()
@@ -1,22 +1,24 @@
 from dotenv import load_dotenv
 load_dotenv()
 
-import json
+import asyncio
 import os
-import re
+from collections import Counter
 from fastapi import FastAPI
 from pydantic import BaseModel
 
-from agent.app.rag import retrieve
-from agent.app.prompt import build_prompt
-from agent.app.llm_provider import generate
+from agent.app.rag import retrieve, start_embed_batcher, stop_embed_batcher, warmup
+from agent.app.prompt import MAX_EXCERPT, SYSTEM_PROMPT, build_prompt
+from agent.app.llm_provider import aclose_client, generate
 from agent.app.verify import validate_evidence
-from agent.app.graph import GRAPH
+from agent.app.utils import clean_ws, is_object_count_question, parse_llm_json, query_intent, scan_intents
+from agent.app.graph import GRAPH, build_object_index, build_plan, node_object_verify, _score
 
 import traceback
-from fastapi.responses import PlainTextResponse
+from fastapi.responses import ORJSONResponse, PlainTextResponse
 
-app = FastAPI(title="AICI Agent Service", version="0.8.2")
+# orjson serializes the answer payload (sources/excerpts/object_summary) in Rust
+app = FastAPI(title="AICI Agent Service", version="0.8.2", default_response_class=ORJSONResponse)
 
 
 @app.exception_handler(Exception)
@@ -32,39 +34,19 @@ class AnswerRequest(BaseModel):
     quote_mode: bool | None = True
 
 
-def _extract_json_block(s: str) -> str:
-    s = (s or "").strip()
-    i = s.find("{")
-    j = s.rfind("}")
-    if i == -1 or j == -1 or j <= i:
-        return s
-    return s[i : j + 1]
-
-
-def _meta() -> dict:
-    """
-    Return provider/model info from environment so responses stay accurate
-    when you switch models/providers in docker-compose/.env.
-    """
-    provider = os.getenv("LLM_PROVIDER", "ollama").strip()
+# Provider/model info for responses. Env doesn't change mid-process, so snapshot it
+# once at import (after load_dotenv); switch models/providers in docker-compose/.env.
+_META = {
+    "provider": os.getenv("LLM_PROVIDER", "ollama").strip(),
     # try multiple common env names
-    model = (
+    "model": (
         os.getenv("OLLAMA_MODEL")
         or os.getenv("OPENAI_MODEL")
         or os.getenv("MODEL_NAME")
         or "unknown"
-    )
-    return {"provider": provider, "model": model}
-
+    ),
+}
 
-_PAGE_RE = re.compile(r"\b(?:page|p\.?|sayfa)\s*#?\s*(\d{1,3})\b", re.IGNORECASE)
-
-# Heuristic: pure object counting questions -> no retrieval needed
-_OBJ_COUNT_RE = re.compile(r"\b(how many|kaç|adet)\b", re.IGNORECASE)
-_OBJ_HINT_RE = re.compile(
-    r"\b(object|objects|layer|katman|type|tip|polyline|line|window|windows|highway|nesne|obje)\b",
-    re.IGNORECASE,
-)
 
 # optional env toggle (default ON)
 _DISABLE_RETRIEVAL_FOR_OBJECT_Q = (
@@ -72,11 +54,19 @@ _DISABLE_RETRIEVAL_FOR_OBJECT_Q = (
 )
 
 
-def _is_object_count_question(q: str) -> bool:
-    q = (q or "").strip()
-    if not q:
-        return False
-    return (_OBJ_COUNT_RE.search(q) is not None) and (_OBJ_HINT_RE.search(q) is not None)
+def _annotate_hits(hits: list[dict]) -> list[dict]:
+    """
+    Attach cached per-hit views once so graph nodes don't re-extract metadata,
+    re-lowercase text, re-clean excerpts or re-parse scores on every access.
+    """
+    for h in hits:
+        h["_md"] = h.get("metadata") or {}
+        h["_text_lc"] = (h.get("text") or "").lower()
+        h["_score_f"] = _score(h)
+        # whitespace-normalized excerpt shown to the LLM (build_prompt) and checked
+        # by verify.build_source_maps; truncated WITHOUT adding "..."
+        h["_excerpt"] = clean_ws(h.get("text") or "")[:MAX_EXCERPT]
+    return hits
 
 
 @app.get("/health")
@@ -84,47 +74,108 @@ def health():
     return {"status": "ok", "service": "agent"}
 
 
-@app.post("/answer")
-def answer(req: AnswerRequest):
-    obj_list = req.object_list or []
+@app.on_event("startup")
+async def _warm_retrieval():
+    # Chroma client/collection + ONNX session, off the event loop
+    await asyncio.to_thread(warmup)
+    start_embed_batcher()
 
-    # ---- Ephemeral object summary ----
-    by_layer: dict[str, int] = {}
-    by_type: dict[str, int] = {}
 
-    for obj in obj_list:
-        if not isinstance(obj, dict):
-            continue
-        layer = obj.get("layer", "UNKNOWN")
-        by_layer[layer] = by_layer.get(layer, 0) + 1
+@app.on_event("shutdown")
+async def _shutdown():
+    await stop_embed_batcher()
+    await aclose_client()
 
-        t = obj.get("type", "UNKNOWN")
-        by_type[t] = by_type.get(t, 0) + 1
+
+def _summarize_objects(obj_list: list) -> tuple[dict, dict]:
+    """Ephemeral object summary (+ case-insensitive index for the graph)."""
+    # Counter does the per-object increments in C; dict() keeps the plain JSON shape
+    by_layer: dict[str, int] = {}
+    by_type: dict[str, int] = {}
+    if obj_list:
+        objs = [o for o in obj_list if isinstance(o, dict)]
+        by_layer = dict(Counter(o.get("layer", "UNKNOWN") for o in objs))
+        by_type = dict(Counter(o.get("type", "UNKNOWN") for o in objs))
 
     object_summary = {
         "total_objects": len(obj_list),
         "by_layer": by_layer,
         "by_type": by_type,
     }
+    # case-insensitive layer/type lookups for the graph (kept out of object_summary,
+    # which is echoed in the prompt and the response)
+    return object_summary, build_object_index(object_summary)
+
+
+@app.post("/answer")
+async def answer(req: AnswerRequest):
+    obj_list = req.object_list or []
 
     q = (req.question or "").strip()
+    intents = scan_intents(q)
+    # every question-level regex runs once here; retrieval, prompt and validation reuse it
+    qi = query_intent(q, intents)
 
     # ---- Retrieval decision ----
     # If this is a pure object counting question, skip retrieval to avoid irrelevant sources.
-    skip_retrieval = _DISABLE_RETRIEVAL_FOR_OBJECT_Q and _is_object_count_question(q)
+    skip_retrieval = _DISABLE_RETRIEVAL_FOR_OBJECT_Q and is_object_count_question(intents)
 
     hits = []
     effective_top_k = req.top_k if req.top_k is not None else 2
-    if not skip_retrieval:
-        if _PAGE_RE.search(q):
+    if skip_retrieval:
+        object_summary, object_index = _summarize_objects(obj_list)
+
+        # Plain "how many objects" (no layer/type target): the answer is just the total,
+        # so skip the graph walk and answer directly.
+        plan = build_plan(q, intents, has_caption=False)
+        if plan["strategy"] == "direct_object_count":
+            # same strict YES/NO / number-only check node_draft applies to direct answers
+            n = validate_evidence(
+                {"answer": str(object_summary["total_objects"]), "evidence": []}, [], req.question, qi
+            )["answer"]
+            meta = {**_META, "format": "shortcircuit"}
+            if not req.quote_mode:
+                return {
+                    "answer": n,
+                    "evidence": [],
+                    "object_summary": object_summary,
+                    "sources": [],
+                    "meta": meta,
+                }
+            verified = node_object_verify(
+                {
+                    "question": req.question,
+                    "object_summary": object_summary,
+                    "object_index": object_index,
+                    "intents": intents,
+                    "object_list": obj_list,
+                    "hits": [],
+                }
+            )
+            return {
+                "answer": n,
+                "evidence": [],
+                "object_checks": verified["object_checks"],
+                "object_summary": object_summary,
+                "sources": [],
+                "plan": plan,
+                "meta": meta,
+            }
+    else:
+        if "page" in intents:
             effective_top_k = max(int(effective_top_k), 5)
-        hits = retrieve(req.question, top_k=effective_top_k)
+        # retrieval (batched embedding + Chroma in a worker thread) overlaps the object summary
+        (object_summary, object_index), hits = await asyncio.gather(
+            asyncio.to_thread(_summarize_objects, obj_list),
+            retrieve(req.question, top_k=effective_top_k, intent=qi),
+        )
+        hits = _annotate_hits(hits)
 
     # ---- Sources ----
     sources = []
     if not skip_retrieval:
         for h in hits:
-            md = h.get("metadata") or {}
+            md = h["_md"]
             source_item = {
                 "chunk_id": h.get("chunk_id"),
                 "score": h.get("score"),
@@ -135,18 +186,20 @@ def answer(req: AnswerRequest):
             }
 
             if req.evidence_mode:
-                txt = (h.get("text") or "").replace("\n", " ").strip()
-                source_item["excerpt"] = " ".join(txt.split())[:500]
+                source_item["excerpt"] = h["_excerpt"][:500]
 
             sources.append(source_item)
 
     # ---- Quote mode (LangGraph) ----
     if req.quote_mode:
         result = (
-            GRAPH.invoke(
+            await GRAPH.ainvoke(
                 {
                     "question": req.question,
                     "object_summary": object_summary,
+                    "object_index": object_index,
+                    "intents": intents,
+                    "query_intent": qi,
                     "object_list": obj_list,
                     "hits": hits,
                     "retry_count": 0,
@@ -159,18 +212,10 @@ def answer(req: AnswerRequest):
         plan = result.get("plan") or {}
         strategy = (plan.get("strategy") or "").strip()
 
-        used_hits = result.get("used_hits") or hits
-
         # ✅ direct_* stratejilerde evidence zorunlu değil
         if not strategy.startswith("direct_"):
-            try:
-                result = validate_evidence(result, used_hits)
-            except Exception:
-                result = {
-                    "answer": "I don't have enough information in the provided excerpts.",
-                    "evidence": [],
-                }
-
+            # node_parse_and_validate already checked this evidence against the same
+            # used_hits (the graph returns them), so it isn't re-validated here
             if not (result.get("evidence") or []):
                 result["answer"] = "I don't have enough information in the provided excerpts."
                 result["evidence"] = []
@@ -186,17 +231,20 @@ def answer(req: AnswerRequest):
             "object_summary": object_summary,
             "sources": sources,  # will be [] for pure object count qs
             "plan": plan,
-            "meta": {**_meta(), "format": "langgraph_json_with_quotes"},
+            "meta": {**_META, "format": "langgraph_json_with_quotes"},
         }
 
     # ---- Non-quote mode ----
     if skip_retrieval:
         # deterministic object answer via graph (no LLM)
         result = (
-            GRAPH.invoke(
+            await GRAPH.ainvoke(
                 {
                     "question": req.question,
                     "object_summary": object_summary,
+                    "object_index": object_index,
+                    "intents": intents,
+                    "query_intent": qi,
                     "object_list": obj_list,
                     "hits": [],
                     "retry_count": 0,
@@ -212,16 +260,15 @@ def answer(req: AnswerRequest):
             "evidence": result.get("evidence", []),
             "object_summary": object_summary,
             "sources": [],
-            "meta": {**_meta(), "format": "plain_text"},
+            "meta": {**_META, "format": "plain_text"},
         }
 
     # ---- LLM-only fallback (non-quote mode) ----
-    prompt = build_prompt(req.question, object_summary, hits)
-    raw = generate(prompt)
+    prompt = build_prompt(req.question, object_summary, hits, qi)
+    raw = await generate(prompt, system=SYSTEM_PROMPT)
 
-    candidate = _extract_json_block(raw)
     try:
-        parsed = json.loads(candidate)
+        parsed = parse_llm_json(raw)
         parsed = validate_evidence(parsed, hits)
         final_answer = parsed.get("answer") or raw
         evidence = parsed.get("evidence") or []
@@ -234,5 +281,5 @@ def answer(req: AnswerRequest):
         "evidence": evidence,
         "object_summary": object_summary,
         "sources": sources,
-        "meta": {**_meta(), "format": "plain_text"},
+        "meta": {**_META, "format": "plain_text"},
     }
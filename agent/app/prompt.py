@@ -1,56 +1,46 @@
 import json
 import re
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterator, Optional
 
-VISUAL_INTENT_RE = re.compile(
-    r"\b(diagram|figure|table|chart|flowchart|illustration|şekil|tablo)\b",
-    re.IGNORECASE,
-)
+import orjson
 
-PAGE_RE = re.compile(r"\b(?:page|p\.?|sayfa)\s*#?\s*(\d{1,3})\b", re.IGNORECASE)
-
-# NEW: strict output-intent detection
-YESNO_ONLY_RE = re.compile(
-    r"\b(answer\s+yes\/no|answer\s+(yes|no)|reply\s+with\s+only\s+(yes|no)|yes\/no|evet\/hayir|evet\s*mi\s*hayir\s*mi)\b",
-    re.IGNORECASE,
-)
-NUMBER_ONLY_RE = re.compile(
-    r"\b(reply\s+with\s+only\s+the\s+number|only\s+the\s+number|sadece\s+sayı|yalnızca\s+sayı|yalnızca\s+rakam)\b",
-    re.IGNORECASE,
-)
+from agent.app.utils import QueryIntent, clean_ws, query_intent
 
 MAX_EXCERPT = 700
 MAX_QUOTE = 180
 MAX_CANDIDATES = 8
 
 
-def _clean_ws(s: str) -> str:
-    return " ".join((s or "").replace("\n", " ").split()).strip()
-
+# Anchor phrases that make good quote candidates
+ANCHORS = [
+    "This restriction means that",
+    "will require an application for planning permission",
+    "Eaves height is measured",
+    "obscure glazed to minimum of level 3",
+    "There will only be one principal elevation",
+    "the principal elevation will be what is understood",
+]
+# one case-insensitive scan for all anchors (none of them overlap each other); the
+# named group tells which anchor matched, since lowering the match text isn't safe
+# ("THİS", "ıs" and "ſ" match case-insensitively but don't lower to the anchor)
+_ANCHOR_RE = re.compile(
+    "|".join(f"(?P<a{i}>{re.escape(a)})" for i, a in enumerate(ANCHORS)),
+    re.IGNORECASE,
+)
 
-def _asked_page(question: str) -> int | None:
-    m = PAGE_RE.search(question or "")
-    if not m:
-        return None
-    try:
-        p = int(m.group(1))
-        if 1 <= p <= 999:
-            return p
-    except Exception:
-        return None
-    return None
 
+def _anchor_spans(ex: str) -> List[str]:
+    # first occurrence of each anchor, returned in ANCHORS order
+    first: Dict[int, re.Match] = {}
+    for m in _ANCHOR_RE.finditer(ex):
+        first.setdefault(int(m.lastgroup[1:]), m)
 
-def _anchor_spans(ex: str, anchors: List[str]) -> List[str]:
     out: List[str] = []
-    low = ex.lower()
-    for a in anchors:
-        idx = low.find(a.lower())
-        if idx == -1:
-            continue
-        start = max(0, idx - 40)
-        end = min(len(ex), idx + len(a) + 120)
-        cand = _clean_ws(ex[start:end])
+    for i in sorted(first):
+        m = first[i]
+        start = max(0, m.start() - 40)
+        end = min(len(ex), m.end() + 120)
+        cand = clean_ws(ex[start:end])
         if len(cand) > MAX_QUOTE:
             cand = cand[:MAX_QUOTE]
         if cand:
@@ -58,8 +48,23 @@ def _anchor_spans(ex: str, anchors: List[str]) -> List[str]:
     return out
 
 
+# Sentence boundaries for the fallback split: whitespace after . ! ? (kept with the
+# sentence) or after ; (dropped). Excerpts are clean_ws()'d, so whitespace is always
+# a single space and the scan never has to backtrack over runs.
+_SENT_SPLIT_RE = re.compile(r"(?<=[.!?]) |; ")
+
+
+def _iter_sentences(ex: str) -> Iterator[str]:
+    # lazy re.split: callers stop after MAX_CANDIDATES without scanning the rest
+    pos = 0
+    for m in _SENT_SPLIT_RE.finditer(ex):
+        yield ex[pos:m.start()]
+        pos = m.end()
+    yield ex[pos:]
+
+
 def _make_quote_candidates(excerpt: str) -> List[str]:
-    ex = _clean_ws(excerpt)
+    ex = clean_ws(excerpt)
     if not ex:
         return []
 
@@ -69,7 +74,7 @@ def _make_quote_candidates(excerpt: str) -> List[str]:
     if " - " in ex:
         parts = ex.split(" - ")
         for p in parts:
-            p = _clean_ws(p)
+            p = clean_ws(p)
             if not p:
                 continue
             if p.lower().startswith("figure/table caption"):
@@ -82,21 +87,12 @@ def _make_quote_candidates(excerpt: str) -> List[str]:
 
     # 2) Anchor'lar (restriction/measurement gibi yerlerde işe yarıyor)
     if len(cands) < 3:
-        anchors = [
-            "This restriction means that",
-            "will require an application for planning permission",
-            "Eaves height is measured",
-            "obscure glazed to minimum of level 3",
-            "There will only be one principal elevation",
-            "the principal elevation will be what is understood",
-        ]
-        cands.extend(_anchor_spans(ex, anchors))
+        cands.extend(_anchor_spans(ex))
 
     # 3) yoksa sentence split
     if not cands:
-        parts = re.split(r"(?<=[\.\!\?])\s+|;\s+", ex)
-        for p in parts:
-            p = _clean_ws(p)
+        for p in _iter_sentences(ex):
+            p = clean_ws(p)
             if not p:
                 continue
             if len(p) > MAX_QUOTE:
@@ -121,76 +117,37 @@ def _make_quote_candidates(excerpt: str) -> List[str]:
     return out[:MAX_CANDIDATES]
 
 
-def build_prompt(question: str, object_summary: Dict[str, Any], retrieved: List[Dict[str, Any]]) -> str:
-    ctx_blocks: list[str] = []
-    has_caption = False
-
-    for i, h in enumerate(retrieved, start=1):
-        md = h.get("metadata") or {}
-        filename = md.get("filename", "unknown")
-        page = md.get("page", "unknown")
-        section = md.get("section", None)
-        kind = md.get("kind", "text")
-        if kind == "caption":
-            has_caption = True
-
-        chunk_id = h.get("chunk_id", f"chunk_{i}")
-
-        # IMPORTANT: truncate WITHOUT adding "..."
-        text = _clean_ws(h.get("text") or "")
-        if len(text) > MAX_EXCERPT:
-            text = text[:MAX_EXCERPT]
-
-        quote_candidates = _make_quote_candidates(text)
-        qc_lines = "\n".join([f"  - {c}" for c in quote_candidates]) if quote_candidates else "  - (none)"
-
-        ctx_blocks.append(
-            f"SOURCE {i}\n"
-            f"kind: {kind}\n"
-            f"chunk_id: {chunk_id}\n"
-            f"file: {filename}\n"
-            f"page: {page}\n"
-            f"section: {section}\n"
-            f"excerpt: {text}\n"
-            f"quote_candidates (copy EXACTLY one of these as evidence.quote):\n"
-            f"{qc_lines}"
-        )
-
-    context = "\n\n".join(ctx_blocks) if ctx_blocks else "NO_EXCERPTS_FOUND"
-
-    # Allow evidence to be empty for purely object-based direct answers,
-    # but for any document claim we need evidence.
-    schema = {
-        "answer": "string (max 3 sentences, unless strict YES/NO or number-only is requested)",
-        "evidence": [{"source_id": 1, "chunk_id": "string", "quote": "string (<=180 chars)"}],
-    }
-
-    obj_json = json.dumps(object_summary or {}, ensure_ascii=False)
-    visual_intent = VISUAL_INTENT_RE.search(question or "") is not None
-    asked_page = _asked_page(question)
+# Output schema. Allow evidence to be empty for purely object-based direct answers,
+# but for any document claim we need evidence.
+_SCHEMA = {
+    "answer": "string (max 3 sentences, unless strict YES/NO or number-only is requested)",
+    "evidence": [{"source_id": 1, "chunk_id": "string", "quote": "string (<=180 chars)"}],
+}
 
-    yesno_only = YESNO_ONLY_RE.search(question or "") is not None
-    number_only = NUMBER_ONLY_RE.search(question or "") is not None
+_EMPTY_OBJ_JSON = "{}"
 
-    return f"""You are a hybrid RAG QA agent.
+# Static instructions, sent separately from the per-request part (Ollama "system" /
+# OpenAI system message) so the backend can reuse its prefix instead of
+# re-processing the same preamble on every call.
+SYSTEM_PROMPT = f"""You are a hybrid RAG QA agent.
 
 Return ONLY valid JSON (no markdown, no backticks).
 
-OBJECT_SUMMARY (session-only; OK to use it for object counting/presence, NOT for document facts):
-{obj_json}
+Each request gives OBJECT_SUMMARY, QUESTION_FLAGS, SOURCES and the Question.
+OBJECT_SUMMARY is session-only; OK to use it for object counting/presence, NOT for document facts.
 
 SOURCE KIND:
 - kind=text    => extracted PDF text
 - kind=caption => generated from a page image (diagram/table/figure)
 
 STRICT OUTPUT MODES:
-- If the question requests YES/NO only (yesno_only={str(yesno_only).lower()}), then answer MUST be exactly "YES" or "NO" (no extra words).
-- If the question requests number-only (number_only={str(number_only).lower()}), then answer MUST be only digits (e.g., "3"), nothing else.
+- If the question requests YES/NO only (QUESTION_FLAGS yesno_only=true), then answer MUST be exactly "YES" or "NO" (no extra words).
+- If the question requests number-only (QUESTION_FLAGS number_only=true), then answer MUST be only digits (e.g., "3"), nothing else.
 
 DOCUMENT RULES:
 - Use ONLY the SOURCES for factual claims about the document.
-- If asked_page={asked_page} is not None, prefer SOURCES from that page.
-- If visual_intent=true and there is at least one kind=caption source:
+- If QUESTION_FLAGS asked_page is not None, prefer SOURCES from that page.
+- If QUESTION_FLAGS visual_intent=true and there is at least one kind=caption source:
   - Answer MUST primarily summarize caption content.
 - Use kind=caption for "what is shown"; use kind=text for rules/measurements/definitions.
 
@@ -208,16 +165,81 @@ EVIDENCE RULES:
 - If the question explicitly asks for a quote from page X, provide at least one evidence item from that page if available.
 
 IMPORTANT (visual questions):
-- If the question asks about a diagram/figure/table AND there is NO kind=caption source, output EXACTLY:
+- If the question asks about a diagram/figure/table AND there is NO kind=caption source (QUESTION_FLAGS has_caption=false), output EXACTLY:
   {{ "answer": "I don't have enough information in the provided excerpts.", "evidence": [] }}
 
 If you cannot support any document claim with an exact quote, output EXACTLY:
 {{ "answer": "I don't have enough information in the provided excerpts.", "evidence": [] }}
 
-Question visual_intent={str(visual_intent).lower()} has_caption={str(has_caption).lower()}
-
 JSON schema:
-{json.dumps(schema, indent=2)}
+{json.dumps(_SCHEMA, indent=2)}
+"""
+
+
+def build_prompt(
+    question: str,
+    object_summary: Dict[str, Any],
+    retrieved: List[Dict[str, Any]],
+    intent: Optional[QueryIntent] = None,
+) -> str:
+    """Per-request part of the prompt; pair it with SYSTEM_PROMPT when calling generate()."""
+    ctx_blocks: list[str] = []
+    has_caption = False
+
+    for i, h in enumerate(retrieved, start=1):
+        md = h.get("metadata") or {}
+        filename = md.get("filename", "unknown")
+        page = md.get("page", "unknown")
+        section = md.get("section", None)
+        kind = md.get("kind", "text")
+        if kind == "caption":
+            has_caption = True
+
+        chunk_id = h.get("chunk_id", f"chunk_{i}")
+
+        # main.py precomputes this excerpt once per hit (shared with verify.py)
+        text = h.get("_excerpt")
+        if text is None:
+            # IMPORTANT: truncate WITHOUT adding "..."
+            text = clean_ws(h.get("text") or "")
+            if len(text) > MAX_EXCERPT:
+                text = text[:MAX_EXCERPT]
+
+        quote_candidates = _make_quote_candidates(text)
+        qc_lines = ("  - " + "\n  - ".join(quote_candidates)) if quote_candidates else "  - (none)"
+
+        ctx_blocks.append(
+            f"SOURCE {i}\n"
+            f"kind: {kind}\n"
+            f"chunk_id: {chunk_id}\n"
+            f"file: {filename}\n"
+            f"page: {page}\n"
+            f"section: {section}\n"
+            f"excerpt: {text}\n"
+            f"quote_candidates (copy EXACTLY one of these as evidence.quote):\n"
+            f"{qc_lines}"
+        )
+
+    context = "\n\n".join(ctx_blocks) if ctx_blocks else "NO_EXCERPTS_FOUND"
+
+    # orjson writes UTF-8 as-is (like ensure_ascii=False); layer/type keys from the
+    # client's object_list are not guaranteed to be strings
+    obj_json = (
+        orjson.dumps(object_summary, option=orjson.OPT_NON_STR_KEYS).decode()
+        if object_summary
+        else _EMPTY_OBJ_JSON
+    )
+    if intent is None:
+        intent = query_intent(question)
+    visual_intent = intent.visual
+    asked_page = intent.asked_page
+    yesno_only = intent.yesno_only
+    number_only = intent.number_only
+
+    return f"""OBJECT_SUMMARY:
+{obj_json}
+
+QUESTION_FLAGS: yesno_only={str(yesno_only).lower()} number_only={str(number_only).lower()} asked_page={asked_page} visual_intent={str(visual_intent).lower()} has_caption={str(has_caption).lower()}
 
 SOURCES:
 {context}
@@ -1,11 +1,15 @@
+import asyncio
 import os
 import re
 from pathlib import Path
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 
 import chromadb
+import numpy as np
 from fastembed import TextEmbedding
 
+from agent.app.utils import QueryIntent, asked_class_from_question, query_intent
+
 # --- Optional telemetry disable (version-safe) ---
 Settings = None
 try:
@@ -23,14 +27,23 @@ CHROMA_PATH = os.getenv("CHROMA_PATH", str(PROJECT_ROOT / "chroma_db"))
 COLLECTION_NAME = os.getenv("CHROMA_COLLECTION", "docs")
 
 EMBED_MODEL = os.getenv("EMBED_MODEL", "BAAI/bge-small-en-v1.5")
-_EMBEDDER = TextEmbedding(model_name=EMBED_MODEL)
+# fastembed already ships bge-small-en-v1.5 as a quantized ONNX export (and the
+# stored vectors come from the same model), so only the ORT thread count is tunable.
+# Default: half the cores, leaving room for Chroma and the event loop.
+EMBED_THREADS = int(os.getenv("EMBED_THREADS", str(max(1, (os.cpu_count() or 2) // 2))))
+# EMBED_DEVICE=cuda runs the ONNX session on the GPU (needs onnxruntime-gpu); ORT
+# falls back to the CPU provider for anything CUDA can't take.
+EMBED_DEVICE = os.getenv("EMBED_DEVICE", "cpu").strip().lower()
+_EMBED_PROVIDERS = ["CUDAExecutionProvider", "CPUExecutionProvider"] if EMBED_DEVICE == "cuda" else None
+_EMBEDDER = TextEmbedding(model_name=EMBED_MODEL, threads=EMBED_THREADS, providers=_EMBED_PROVIDERS)
 
 # --- Lazy singletons (safe with uvicorn startup/reload) ---
 _CLIENT = None
 _COLLECTION = None
+_SPACE = "l2"  # distance metric of the collection, read in _get_collection()
 
 def _get_collection():
-    global _CLIENT, _COLLECTION
+    global _CLIENT, _COLLECTION, _SPACE
     if _COLLECTION is not None:
         return _COLLECTION
 
@@ -44,58 +57,122 @@ def _get_collection():
         _CLIENT = chromadb.PersistentClient(path=CHROMA_PATH)
 
     _COLLECTION = _CLIENT.get_or_create_collection(name=COLLECTION_NAME)
+    # hnsw:space is fixed when ingest creates the collection; older DBs
+    # (incl. the committed chroma_db until re-ingested) have no entry and use l2
+    _SPACE = ((_COLLECTION.metadata or {}).get("hnsw:space") or "l2").lower()
     return _COLLECTION
 
 
-CLASS_Q_RE = re.compile(r"\bClass\s+([A-Z])\b", re.IGNORECASE)
-CLASS_COVERS_RE = re.compile(r"\bClass\s+([A-Z])\s+covers\b", re.IGNORECASE)
-CLASS_HEADING_RE = re.compile(r"\bClass\s+([A-Z])\s*[–-]\s*", re.IGNORECASE)
+# --- Query embedding micro-batcher ---
+# Concurrent requests are coalesced into one embed() call: the worker waits up to
+# EMBED_BATCH_WINDOW_MS after the first query (or until EMBED_BATCH_MAX queries).
+EMBED_BATCH_MAX = int(os.getenv("EMBED_BATCH_MAX", "8"))
+EMBED_BATCH_WINDOW_MS = float(os.getenv("EMBED_BATCH_WINDOW_MS", "5"))
+
+
+class EmbedBatcher:
+    def __init__(self, max_batch: int, window_ms: float):
+        self.max_batch = max(1, max_batch)
+        self.window = max(0.0, window_ms) / 1000.0
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        """Start the worker on the running event loop (FastAPI startup)."""
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            self._queue = None
+
+    async def embed(self, text: str):
+        if self._task is None:
+            # not started (scripts/tests): embed directly
+            return await asyncio.to_thread(lambda: list(_EMBEDDER.embed([text]))[0])
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, fut))
+        return await fut
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            texts = [t for t, _ in batch]
+            try:
+                vecs = await asyncio.to_thread(lambda: list(_EMBEDDER.embed(texts)))
+            except Exception as e:
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+            for (_, fut), vec in zip(batch, vecs):
+                if not fut.done():
+                    fut.set_result(vec)
+
+
+_BATCHER = EmbedBatcher(EMBED_BATCH_MAX, EMBED_BATCH_WINDOW_MS)
+
+
+def start_embed_batcher() -> None:
+    _BATCHER.start()
+
+
+async def stop_embed_batcher() -> None:
+    await _BATCHER.stop()
+
+
+def warmup() -> None:
+    """Open the collection and run one embedding so the first request doesn't pay init cost."""
+    _get_collection()
+    list(_EMBEDDER.embed([""]))
 
-PAGE_RE = re.compile(r"\b(?:page|p\.?|sayfa)\s*#?\s*(\d{1,3})\b", re.IGNORECASE)
 
-VISUAL_INTENT_RE = re.compile(
-    r"\b(diagram|figure|table|chart|flowchart|illustration|şekil|tablo)\b",
-    re.IGNORECASE,
-)
+CLASS_COVERS_RE = re.compile(r"\bClass\s+([A-Z])\s+covers\b", re.IGNORECASE)
+CLASS_HEADING_RE = re.compile(r"\bClass\s+([A-Z])\s*[–-]\s*", re.IGNORECASE)
 
 REF_PAGE_RE = re.compile(r"\bsee\s+page\s+(\d{1,3})\b", re.IGNORECASE)
 
 ENABLE_KEYWORD_BOOST = os.getenv("ENABLE_KEYWORD_BOOST", "1").strip() == "1"
 ENABLE_FOLLOW_LINKS = os.getenv("ENABLE_FOLLOW_LINKS", "0").strip() == "1"
 ENABLE_LEXICAL_BONUS = os.getenv("ENABLE_LEXICAL_BONUS", "1").strip() == "1"
+# Candidates whose vector score is below this skip the keyword/lexical boosts
+# (no lowercasing/substring scans). 0 = boost everything.
+RERANK_SCORE_FLOOR = float(os.getenv("RERANK_SCORE_FLOOR", "0"))
 
-STOPWORDS = {
+STOPWORDS = frozenset({
     "the", "and", "or", "for", "with", "from", "that", "this", "into", "over",
     "page", "sayfa", "p", "figure", "diagram", "table", "chart", "flowchart",
     "what", "does", "show", "summarize", "in", "on", "of", "to", "a", "an",
     "is", "are", "it", "as", "at", "by", "be", "give", "sentences", "sentence",
     "ve", "ile", "bir", "bu", "şu", "icin", "için", "olarak", "mi", "mı", "mu", "mü",
     "ne", "nedir", "acikla", "açıkla",
-}
-
-def asked_class_from_question(question: str) -> Optional[str]:
-    m = CLASS_Q_RE.search(question or "")
-    if not m:
-        return None
-    return f"Class {m.group(1).upper()}"
-
-def asked_page_from_question(question: str) -> Optional[int]:
-    m = PAGE_RE.search(question or "")
-    if not m:
-        return None
-    try:
-        p = int(m.group(1))
-        if 1 <= p <= 999:
-            return p
-    except Exception:
-        return None
-    return None
+})
 
-def has_visual_intent(question: str) -> bool:
-    return VISUAL_INTENT_RE.search(question or "") is not None
+# min-length filters folded into the token patterns (runs shorter than that never match)
+_QUERY_TERM_RE = re.compile(r"[a-zA-ZğüşöçıİĞÜŞÖÇ0-9]{4,}")
+_LEX_TOKEN_RE = re.compile(r"[a-z0-9ğüşöçı]{3,}")
 
-def normalize_query(query: str) -> str:
-    asked = asked_class_from_question(query)
+def normalize_query(query: str, asked: Optional[str] = None) -> str:
+    if asked is None:
+        asked = asked_class_from_question(query)
     if not asked:
         return query
     ql = query.lower()
@@ -147,90 +224,69 @@ def _to_candidates(res) -> List[Dict[str, Any]]:
     metas = res.get("metadatas", [[]])[0]
     dists = res.get("distances", [[]])[0]
 
-    out: List[Dict[str, Any]] = []
-    for i in range(len(ids)):
-        dist = dists[i] if i < len(dists) else None
-        base_score = None if dist is None else float(1.0 / (1.0 + dist))
-        out.append({
-            "chunk_id": ids[i],
-            "text": docs[i] or "",
-            "metadata": metas[i] or {},
-            "score": base_score,
-        })
-    return out
+    # distance -> score for all hits in one vectorized op (float64: same values as the scalar math)
+    d = np.asarray(dists[: len(ids)], dtype=np.float64)
+    if _SPACE in ("cosine", "ip"):
+        # 1 - cos (or 1 - dot on normalized vectors) is in [0, 2]: map to a [0, 1] similarity
+        scores = (1.0 - 0.5 * d).tolist()
+    else:
+        scores = (1.0 / (1.0 + d)).tolist()
+
+    # Chroma returns ids/documents/metadatas/distances aligned per hit
+    return [
+        {"chunk_id": cid, "text": doc or "", "metadata": md or {}, "score": score}
+        for cid, doc, md, score in zip(ids, docs, metas, scores)
+    ]
 
 def _query_terms(query: str) -> List[str]:
     q = (query or "").lower()
-    words = re.findall(r"[a-zA-ZğüşöçıİĞÜŞÖÇ0-9]+", q)
-    terms = []
-    for w in words:
-        w = w.strip().lower()
-        if len(w) < 4:
-            continue
-        if w in STOPWORDS:
-            continue
-        terms.append(w)
-    seen = set()
-    out = []
-    for t in terms:
-        if t in seen:
-            continue
-        seen.add(t)
-        out.append(t)
-    return out[:12]
-
-def _keyword_boost_score(query: str, text: str) -> float:
-    if not ENABLE_KEYWORD_BOOST:
-        return 0.0
-    terms = _query_terms(query)
-    if not terms:
-        return 0.0
-    tl = (text or "").lower()
-    hits = 0
-    for t in terms:
-        if t in tl:
-            hits += 1
-    return min(0.18, 0.03 * hits)
+    # dict.fromkeys: order-preserving dedupe
+    return list(dict.fromkeys(w for w in _QUERY_TERM_RE.findall(q) if w not in STOPWORDS))[:12]
 
 def _tokenize_lex(s: str) -> List[str]:
     s = (s or "").lower()
-    toks = re.findall(r"[a-z0-9ğüşöçı]+", s)
-    out = []
-    for t in toks:
-        if len(t) < 3:
-            continue
-        if t in STOPWORDS:
-            continue
-        out.append(t)
-    return out[:24]
-
-def _lexical_bonus_score(query: str, text: str) -> float:
-    if not ENABLE_LEXICAL_BONUS:
-        return 0.0
-    qt = _tokenize_lex(query)
-    if not qt:
-        return 0.0
-    tl = (text or "").lower()
-    hits = 0
-    for t in qt:
-        if t in tl:
-            hits += 1
-    ratio = hits / max(1, len(qt))
-    return 0.25 * ratio
-
-def _apply_keyword_rerank(query: str, candidates: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return [t for t in _LEX_TOKEN_RE.findall(s) if t not in STOPWORDS][:24]
+
+def _rerank_terms(query: str) -> Tuple[List[str], List[str]]:
+    """(keyword-boost terms, lexical tokens) of the query, for _apply_keyword_rerank."""
+    terms = _query_terms(query) if ENABLE_KEYWORD_BOOST else []
+    qt = _tokenize_lex(query) if ENABLE_LEXICAL_BONUS else []
+    return terms, qt
+
+def _apply_keyword_rerank(
+    query: str,
+    candidates: List[Dict[str, Any]],
+    qterms: Optional[Tuple[List[str], List[str]]] = None,
+) -> List[Dict[str, Any]]:
     if not candidates:
         return candidates
 
-    if not (ENABLE_KEYWORD_BOOST or ENABLE_LEXICAL_BONUS):
+    use_kb = ENABLE_KEYWORD_BOOST
+    use_lb = ENABLE_LEXICAL_BONUS
+    if not (use_kb or use_lb):
         candidates.sort(key=lambda x: (x["score"] is not None, x["score"]), reverse=True)
         return candidates
 
+    # One pass per candidate: lowercase once, then keyword boost (query terms,
+    # capped at 0.18) + lexical bonus (share of query tokens found, max 0.25).
+    # Candidates are boosted once per request: the page path reranks caps/txts, then
+    # the pool, then the merged list, and those later calls only re-sort.
+    # _search tokenizes the query once and passes it to every rerank call
+    terms, qt = qterms if qterms is not None else _rerank_terms(query)
+    n_qt = max(1, len(qt))
+
     for c in candidates:
+        if c.get("_scored"):
+            continue
+        c["_scored"] = True
         s = c.get("score")
         base = float(s) if s is not None else 0.0
-        kb = _keyword_boost_score(query, c.get("text") or "")
-        lb = _lexical_bonus_score(query, c.get("text") or "")
+        if base < RERANK_SCORE_FLOOR:
+            c["score"] = base
+            continue
+        tl = (c.get("text") or "").lower()
+        kb = min(0.18, 0.03 * sum(t in tl for t in terms)) if terms else 0.0
+        lb = 0.25 * (sum(t in tl for t in qt) / n_qt) if qt else 0.0
         c["score"] = base + kb + lb
 
     candidates.sort(key=lambda x: (x["score"] is not None, x["score"]), reverse=True)
@@ -256,36 +312,51 @@ def _follow_link_pages(text: str) -> List[int]:
         res.append(p)
     return res[:2]
 
-def retrieve(query: str, top_k: int = 5) -> List[Dict[str, Any]]:
-    collection = _get_collection()
-
-    page_intent = asked_page_from_question(query)
-    visual_intent = has_visual_intent(query)
-    asked_class = asked_class_from_question(query)
+async def retrieve(query: str, top_k: int = 5, intent: Optional[QueryIntent] = None) -> List[Dict[str, Any]]:
+    # main.py passes the intent it already computed for this question
+    if intent is None:
+        intent = query_intent(query)
+    page_intent = intent.asked_page
+    asked_class = intent.asked_class
 
     query_norm = query
     if asked_class and page_intent is None:
-        query_norm = normalize_query(query)
+        query_norm = normalize_query(query, asked_class)
 
-    q_vec = list(_EMBEDDER.embed([query_norm]))[0]
+    q_vec = await _BATCHER.embed(query_norm)
+    # Chroma calls are blocking: keep them off the event loop
+    return await asyncio.to_thread(_search, query, q_vec, top_k, page_intent, asked_class, intent.visual)
+
+
+def _search(
+    query: str,
+    q_vec,
+    top_k: int,
+    page_intent: Optional[int],
+    asked_class: Optional[str],
+    visual_intent: bool,
+) -> List[Dict[str, Any]]:
+    collection = _get_collection()
     raw_k = max(top_k * 6, 18)
+    qterms = _rerank_terms(query)
 
     if page_intent is not None:
-        caption_where = _and_where({"page": page_intent}, {"kind": "caption"})
-        text_where = _and_where({"page": page_intent}, {"kind": "text"})
-        any_where = {"page": page_intent}
+        # One ANN query for the page, split by kind in Python. Pages hold far fewer
+        # than raw_k * 2 chunks, so this returns the same caption/text sets as
+        # separate per-kind queries.
+        page_hits = _to_candidates(_query(collection, q_vec, raw_k * 2, {"page": page_intent}))
 
-        caps = _to_candidates(_query(collection, q_vec, raw_k, caption_where)) if visual_intent else []
-        txts = _to_candidates(_query(collection, q_vec, raw_k, text_where))
-
-        caps = _apply_keyword_rerank(query, caps)
-        txts = _apply_keyword_rerank(query, txts)
+        caps = [c for c in page_hits if c["metadata"].get("kind") == "caption"][:raw_k] if visual_intent else []
 
         if visual_intent and not caps:
-            mix = _to_candidates(_query(collection, q_vec, raw_k, any_where))
-            mix = _apply_keyword_rerank(query, mix)
+            mix = _apply_keyword_rerank(query, page_hits[:raw_k], qterms)
             return mix[:top_k]
 
+        txts = [c for c in page_hits if c["metadata"].get("kind") == "text"][:raw_k]
+
+        caps = _apply_keyword_rerank(query, caps, qterms)
+        txts = _apply_keyword_rerank(query, txts, qterms)
+
         merged: List[Dict[str, Any]] = []
         if caps:
             merged.append(caps[0])
@@ -294,7 +365,7 @@ def retrieve(query: str, top_k: int = 5) -> List[Dict[str, Any]]:
 
         seen = {c["chunk_id"] for c in merged}
         pool = [*caps[1:], *txts[1:]]
-        pool = _apply_keyword_rerank(query, pool)
+        pool = _apply_keyword_rerank(query, pool, qterms)
         for c in pool:
             if c["chunk_id"] in seen:
                 continue
@@ -307,9 +378,22 @@ def retrieve(query: str, top_k: int = 5) -> List[Dict[str, Any]]:
             ref_pages = []
             for c in merged[:2]:
                 ref_pages.extend(_follow_link_pages(c.get("text") or ""))
+            # one query for all linked pages, then the same per-page top-n as before.
+            # Over-fetch raw_k per page (pages hold fewer chunks than that) so a dense
+            # page can't take the other page's slots before the per-page trim.
+            per_page = max(4, top_k)
+            by_page: Dict[int, List[Dict[str, Any]]] = {rp: [] for rp in ref_pages}
+            if by_page:
+                n_linked = min(raw_k * len(by_page), collection.count())
+                linked = _to_candidates(
+                    _query(collection, q_vec, max(1, n_linked), {"page": {"$in": list(by_page)}})
+                )
+                for c in linked:
+                    bucket = by_page.get(c["metadata"].get("page"))
+                    if bucket is not None and len(bucket) < per_page:
+                        bucket.append(c)
             for rp in ref_pages:
-                extra = _to_candidates(_query(collection, q_vec, max(4, top_k), {"page": rp}))
-                extra = _apply_keyword_rerank(query, extra)
+                extra = _apply_keyword_rerank(query, by_page[rp], qterms)
                 for e in extra:
                     if e["chunk_id"] in seen:
                         continue
@@ -318,7 +402,7 @@ def retrieve(query: str, top_k: int = 5) -> List[Dict[str, Any]]:
                     if len(merged) >= max(top_k, 6):
                         break
 
-        merged = _apply_keyword_rerank(query, merged)
+        merged = _apply_keyword_rerank(query, merged, qterms)
         return merged[:top_k]
 
     where = None
@@ -337,5 +421,5 @@ def retrieve(query: str, top_k: int = 5) -> List[Dict[str, Any]]:
             if s is not None:
                 c["score"] = max(0.0, float(s) - penalty + boost)
 
-    candidates = _apply_keyword_rerank(query, candidates)
+    candidates = _apply_keyword_rerank(query, candidates, qterms)
     return candidates[:top_k]
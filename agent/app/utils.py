@@ -0,0 +1,152 @@
+import re
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+import orjson
+
+# --- Intent detection (router) ---
+# All boolean intents are fused into ONE alternation so the question is scanned
+# in a single pass. Each named group maps to the intents it signals; phrases that
+# belong to several intents (e.g. "var mı" = object + presence) get their own group.
+# "what is" only consumes "what" so a following "is there any" still matches.
+ROUTER_RE = re.compile(
+    r"(?P<page>\b(?:page|p\.?|sayfa)\s*#?\s*(?P<page_no>\d{1,3})\b)"
+    r"|(?P<visual>\b(?:diagram|figure|table|chart|flowchart|illustration|şekil|tablo)\b)"
+    # YES/NO intent
+    r"|(?P<yesno>\b(?:yes\/no|yes or no|reply with only (?:yes|no)|answer (?:yes|no)|evet\/hayir|evet mi hayir mi)\b)"
+    # Presence intent ("any object" phrases are object hints, TR phrases are object-related)
+    r"|(?P<presence_hint>\b(?:any object on|have any object)\b)"
+    r"|(?P<presence_obj>\b(?:var mı|mevcut mu|bulunuyor mu)\b)"
+    r"|(?P<presence>\b(?:do i have|is there any)\b)"
+    # Counting intent (TR words are object-related too)
+    r"|(?P<count_obj>\b(?:kaç|adet)\b)"
+    r"|(?P<count>\bhow many\b)"
+    # Object-related intent (TR+EN); "hint" words also mark object counting questions
+    r"|(?P<obj_ctx>\b(?:object_list|session)\b)"
+    r"|(?P<hint>\b(?:object|objects|layer|katman|type|tip|polyline|line|window|windows|highway|nesne|obje)\b)"
+    # Doc-span intent: user asking "what does page X explain", "what is the restriction", "measure", etc.
+    r"|(?P<doc>\b(?:explain|restriction|means|rule|measured|measure|how to|what(?= is\b)|define|definition|nedir|açıkla|tanım|ölç|kural|kısıt)\b)",
+    re.IGNORECASE,
+)
+
+_INTENT_GROUPS = {
+    "page": ("page",),
+    "visual": ("visual",),
+    "yesno": ("yesno",),
+    "presence_hint": ("presence", "obj", "hint"),
+    "presence_obj": ("presence", "obj"),
+    "presence": ("presence",),
+    "count_obj": ("count", "obj"),
+    "count": ("count",),
+    "obj_ctx": ("obj",),
+    "hint": ("obj", "hint"),
+    "doc": ("doc",),
+}
+
+
+CLASS_Q_RE = re.compile(r"\bClass\s+([A-Z])\b", re.IGNORECASE)
+
+# Strict output-intent detection (prompt.py asks for it, verify.py enforces it)
+YESNO_ONLY_RE = re.compile(
+    r"\b(answer\s+yes\/no|answer\s+(yes|no)|reply\s+with\s+only\s+(yes|no)|yes\/no|evet\/hayir|evet\s*mi\s*hayir\s*mi)\b",
+    re.IGNORECASE,
+)
+NUMBER_ONLY_RE = re.compile(
+    r"\b(reply\s+with\s+only\s+the\s+number|only\s+the\s+number|sadece\s+sayı|yalnızca\s+sayı|yalnızca\s+rakam)\b",
+    re.IGNORECASE,
+)
+
+# Only runs of 2+ whitespace chars or a single non-space one (\n, \t, \xa0, ...) need
+# rewriting; single spaces are left alone, so already-normalized text (excerpts,
+# quotes copied from them) has no matches and sub() hands back the same string.
+_WS_RE = re.compile(r"\s{2,}|[^\S ]")
+
+
+def clean_ws(s: str) -> str:
+    """Normalize whitespace to make substring checks stable."""
+    # one C-level pass; same result as " ".join(s.split()) without the list
+    return _WS_RE.sub(" ", s or "").strip()
+
+
+def _extract_json_block(s: str) -> str:
+    s = (s or "").strip()
+    i = s.find("{")
+    j = s.rfind("}")
+    if i == -1 or j == -1 or j <= i:
+        return s
+    return s[i : j + 1]
+
+
+def parse_llm_json(raw: str) -> Any:
+    """
+    Parse the LLM's JSON reply. Clean output (Ollama format=json) parses directly;
+    otherwise fall back to the outermost {...} block. Raises on invalid JSON.
+    """
+    try:
+        parsed = orjson.loads(raw or "")
+        if isinstance(parsed, dict):
+            return parsed
+    except orjson.JSONDecodeError:
+        pass
+    return orjson.loads(_extract_json_block(raw))
+
+
+def scan_intents(question: str) -> Dict[str, Any]:
+    """
+    Single pass over the question with ROUTER_RE.
+    Returns {intent: first match} for every intent that fired.
+    """
+    found: Dict[str, Any] = {}
+    for m in ROUTER_RE.finditer(question or ""):
+        for intent in _INTENT_GROUPS[m.lastgroup]:
+            found.setdefault(intent, m)
+    return found
+
+
+def asked_page_from_intents(intents: Dict[str, Any]) -> Optional[int]:
+    m = intents.get("page")
+    if not m:
+        return None
+    try:
+        p = int(m.group("page_no"))
+        if 1 <= p <= 999:
+            return p
+    except Exception:
+        return None
+    return None
+
+
+def is_object_count_question(intents: Dict[str, Any]) -> bool:
+    # Heuristic: pure object counting questions -> no retrieval needed
+    return ("count" in intents) and ("hint" in intents)
+
+
+def asked_class_from_question(question: str) -> Optional[str]:
+    m = CLASS_Q_RE.search(question or "")
+    if not m:
+        return None
+    return f"Class {m.group(1).upper()}"
+
+
+@dataclass(frozen=True)
+class QueryIntent:
+    """Question-level facts used by retrieval, prompt building and validation."""
+    visual: bool
+    asked_page: Optional[int]
+    asked_class: Optional[str]
+    yesno_only: bool
+    number_only: bool
+
+
+def query_intent(question: str, intents: Optional[Dict[str, Any]] = None) -> QueryIntent:
+    """Run every question regex once; pass `intents` if scan_intents() already ran."""
+    q = question or ""
+    if intents is None:
+        intents = scan_intents(q)
+    return QueryIntent(
+        visual="visual" in intents,
+        asked_page=asked_page_from_intents(intents),
+        asked_class=asked_class_from_question(q),
+        yesno_only=YESNO_ONLY_RE.search(q) is not None,
+        number_only=NUMBER_ONLY_RE.search(q) is not None,
+    )
@@ -1,70 +1,52 @@
 from typing import Dict, Any, List, Optional
 import re
 
+from agent.app.utils import QueryIntent, clean_ws, query_intent
+
 PROMPT_EXCERPT_LEN = 700
 MAX_QUOTE_LEN = 180
 MAX_EVIDENCE = 2
 
-# Strict output intent detection (match prompt.py)
-YESNO_ONLY_RE = re.compile(
-    r"\b(answer\s+yes\/no|answer\s+(yes|no)|reply\s+with\s+only\s+(yes|no)|yes\/no|evet\/hayir|evet\s*mi\s*hayir\s*mi)\b",
-    re.IGNORECASE,
-)
-NUMBER_ONLY_RE = re.compile(
-    r"\b(reply\s+with\s+only\s+the\s+number|only\s+the\s+number|sadece\s+sayı|yalnızca\s+sayı|yalnızca\s+rakam)\b",
-    re.IGNORECASE,
-)
-
-
-def _clean_ws(s: str) -> str:
-    """Normalize whitespace to make substring checks stable."""
-    return " ".join((s or "").replace("\n", " ").split()).strip()
+_DIGITS_RE = re.compile(r"\d+")
 
 
 def build_source_maps(retrieved: List[Dict[str, Any]]) -> Dict[int, Dict[str, Any]]:
-    m: Dict[int, Dict[str, Any]] = {}
-    for i, h in enumerate(retrieved, start=1):
-        excerpt = _clean_ws(h.get("text") or "")
-        # IMPORTANT: truncate WITHOUT adding "..." to avoid substring surprises
-        if len(excerpt) > PROMPT_EXCERPT_LEN:
-            excerpt = excerpt[:PROMPT_EXCERPT_LEN]
-
-        md = h.get("metadata") or {}
-        m[i] = {
-            "chunk_id": h.get("chunk_id"),
-            "excerpt": excerpt,
-            "kind": md.get("kind", "text"),
-            "page": md.get("page"),
-        }
-    return m
-
+    # source_id -> raw hit; excerpts are normalized lazily by source_excerpt()
+    return {i: h for i, h in enumerate(retrieved, start=1)}
 
-def _is_yesno_only(question: str) -> bool:
-    return YESNO_ONLY_RE.search(question or "") is not None
 
-
-def _is_number_only(question: str) -> bool:
-    return NUMBER_ONLY_RE.search(question or "") is not None
+def source_excerpt(h: Dict[str, Any]) -> str:
+    # main.py precomputes the prompt excerpt once per hit
+    excerpt = h.get("_excerpt")
+    if excerpt is None:
+        # IMPORTANT: truncate WITHOUT adding "..." to avoid substring surprises
+        excerpt = clean_ws(h.get("text") or "")[:PROMPT_EXCERPT_LEN]
+    return excerpt
 
 
-def _enforce_strict_answer(payload: Dict[str, Any], question: Optional[str]) -> Dict[str, Any]:
+def _enforce_strict_answer(
+    payload: Dict[str, Any],
+    question: Optional[str],
+    intent: Optional[QueryIntent] = None,
+) -> Dict[str, Any]:
     """
     If question asks for strict YES/NO or number-only, enforce it.
     If not compliant, return fallback payload.
     """
-    q = question or ""
-    ans = _clean_ws(payload.get("answer") or "")
+    if intent is None:
+        intent = query_intent(question or "")
+    ans = clean_ws(payload.get("answer") or "")
 
-    if _is_yesno_only(q):
+    if intent.yesno_only:
         # Must be exactly YES or NO
         if ans.upper() not in {"YES", "NO"}:
             return {"answer": "I don't have enough information in the provided excerpts.", "evidence": []}
         payload["answer"] = ans.upper()
         return payload
 
-    if _is_number_only(q):
+    if intent.number_only:
         # Must be only digits
-        if not re.fullmatch(r"\d+", ans):
+        if not _DIGITS_RE.fullmatch(ans):
             return {"answer": "I don't have enough information in the provided excerpts.", "evidence": []}
         payload["answer"] = ans
         return payload
@@ -76,6 +58,7 @@ def validate_evidence(
     payload: Dict[str, Any],
     retrieved: List[Dict[str, Any]],
     question: Optional[str] = None,
+    intent: Optional[QueryIntent] = None,
 ) -> Dict[str, Any]:
     """
     Strict evidence validator + strict answer mode enforcement (optional question):
@@ -92,14 +75,22 @@ def validate_evidence(
         return {"answer": "I don't have enough information in the provided excerpts.", "evidence": []}
 
     # Enforce strict output modes first (so we can reject malformed answers early)
-    payload = _enforce_strict_answer(payload, question)
-
-    src_map = build_source_maps(retrieved)
+    payload = _enforce_strict_answer(payload, question, intent)
 
     evidence = payload.get("evidence") or []
     if not isinstance(evidence, list):
         evidence = []
 
+    # nothing to check (incl. the strict-mode fallback above): skip the source maps
+    if not evidence:
+        payload["evidence"] = []
+        return payload
+
+    # built on the first evidence item with a usable source_id
+    src_map: Optional[Dict[int, Dict[str, Any]]] = None
+    # sid -> excerpt, normalized only for sources the evidence actually reaches
+    excerpts: Dict[int, str] = {}
+
     valid: List[Dict[str, Any]] = []
     seen_quotes = set()
 
@@ -112,28 +103,34 @@ def validate_evidence(
         except Exception:
             continue
 
+        if src_map is None:
+            src_map = build_source_maps(retrieved)
         src = src_map.get(sid)
-        if not src:
+        if src is None:
             continue
 
         expected_chunk = src.get("chunk_id")
-        excerpt = src.get("excerpt") or ""
 
         if ev.get("chunk_id") != expected_chunk:
             continue
 
-        quote = _clean_ws(ev.get("quote") or "")
+        quote = clean_ws(ev.get("quote") or "")
         if not quote:
             continue
 
         if len(quote) > MAX_QUOTE_LEN:
             continue
 
-        # strict substring check
-        if quote not in excerpt:
+        # duplicates are dropped either way; the set lookup is cheaper than the scan
+        if quote in seen_quotes:
             continue
 
-        if quote in seen_quotes:
+        excerpt = excerpts.get(sid)
+        if excerpt is None:
+            excerpt = excerpts[sid] = source_excerpt(src)
+
+        # strict substring check
+        if quote not in excerpt:
             continue
         seen_quotes.add(quote)
 
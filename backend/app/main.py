@@ -5,6 +5,8 @@ from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, EmailStr
 import httpx
 import os
+import time
+from functools import lru_cache
 from typing import Any
 from datetime import datetime, timedelta, timezone
 
@@ -31,12 +33,44 @@ app.add_middleware(
 
 AGENT_URL = os.getenv("AGENT_URL", "http://127.0.0.1:8001")
 
+# One pooled client for backend -> agent calls (keep-alive instead of a new TCP
+# connection per /qa). The agent is plain HTTP/1.1 (uvicorn), so no HTTP/2 here.
+_AGENT_CLIENT: httpx.AsyncClient | None = None
+
+
+def _agent_client() -> httpx.AsyncClient:
+    # only used from the event loop, so no locking is needed
+    global _AGENT_CLIENT
+    if _AGENT_CLIENT is None:
+        _AGENT_CLIENT = httpx.AsyncClient(
+            timeout=120.0,
+            limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+        )
+    return _AGENT_CLIENT
+
+
+@app.on_event("shutdown")
+async def _close_agent_client():
+    global _AGENT_CLIENT
+    if _AGENT_CLIENT is not None:
+        await _AGENT_CLIENT.aclose()
+        _AGENT_CLIENT = None
+
 # --- JWT settings ---
 JWT_SECRET = os.getenv("JWT_SECRET", "dev-secret-change-me")
 JWT_ALG = "HS256"
 JWT_EXPIRE_MIN = int(os.getenv("JWT_EXPIRE_MIN", "240"))
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# argon2id for new hashes (OWASP baseline: 19 MiB, t=2, p=1) verifies in a fraction
+# of bcrypt's default 12 rounds; bcrypt stays listed so older hashes still verify.
+pwd_context = CryptContext(
+    schemes=["argon2", "bcrypt"],
+    default="argon2",
+    deprecated="auto",
+    argon2__time_cost=int(os.getenv("ARGON2_TIME_COST", "2")),
+    argon2__memory_cost=int(os.getenv("ARGON2_MEMORY_KIB", "19456")),
+    argon2__parallelism=1,
+)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 
 # --- In-memory stores (demo) ---
@@ -90,15 +124,25 @@ def _create_access_token(*, sub: str) -> str:
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALG)
 
 
+@lru_cache(maxsize=4096)
+def _decode_token(token: str) -> tuple[str, Any]:
+    """Verified (sub, exp) of a token; only successful decodes are cached."""
+    payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALG])
+    sub = payload.get("sub")
+    if not sub or not isinstance(sub, str):
+        raise JWTError("Invalid token")
+    return sub, payload.get("exp")
+
+
 def _get_current_user_id(token: str = Depends(oauth2_scheme)) -> str:
     try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALG])
-        sub = payload.get("sub")
-        if not sub or not isinstance(sub, str):
-            raise HTTPException(status_code=401, detail="Invalid token")
-        return sub
+        sub, exp = _decode_token(token)
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
+    # a cached token can outlive its exp: re-check it on every request (same rule as jose)
+    if exp is not None and exp < int(time.time()):
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return sub
 
 
 # ----- Routes -----
@@ -164,7 +208,6 @@ async def qa(req: QARequest, user_id: str = Depends(_get_current_user_id)):
         "quote_mode": True,
     }
 
-    async with httpx.AsyncClient(timeout=120.0) as client:
-        r = await client.post(f"{AGENT_URL}/answer", json=payload)
-        r.raise_for_status()
-        return r.json()
+    r = await _agent_client().post(f"{AGENT_URL}/answer", json=payload)
+    r.raise_for_status()
+    return r.json()
@@ -1,9 +1,12 @@
+import json
+import multiprocessing
 import os
 import re
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Dict, Any, Optional, Tuple
+from typing import Deque, List, Dict, Any, Optional, Set, Tuple
 
-from pypdf import PdfReader
 import chromadb
 from fastembed import TextEmbedding
 
@@ -16,14 +19,33 @@ PROJECT_ROOT = Path(__file__).resolve().parents[1]
 DATA_DIR = PROJECT_ROOT / "data"
 CHROMA_PATH = os.getenv("CHROMA_PATH", str(PROJECT_ROOT / "chroma_db"))
 COLLECTION_NAME = os.getenv("CHROMA_COLLECTION", "docs")
+# Distance metric for a NEW collection (Chroma ignores it for an existing one, so
+# use RESET_COLLECTION=1 to migrate). The agent reads it back to scale scores.
+CHROMA_SPACE = os.getenv("CHROMA_SPACE", "cosine").strip().lower()
 
 EMBED_MODEL = os.getenv("EMBED_MODEL", "BAAI/bge-small-en-v1.5")
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+# chunks are embedded + written to Chroma every INGEST_FLUSH_SIZE chunks (bounded memory)
+INGEST_FLUSH_SIZE = int(os.getenv("INGEST_FLUSH_SIZE", "1024"))
+# PDFs processed in parallel (text extraction, page rendering, VLM captions)
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", str(os.cpu_count() or 1)))
+# caption requests in flight per PDF (Ollama queues beyond OLLAMA_NUM_PARALLEL)
+VLM_CONCURRENCY = max(1, int(os.getenv("VLM_CONCURRENCY", "2")))
+# fastembed data-parallel workers: unset = single process (ONNX Runtime still uses
+# its intra-op threads), 0 = one worker per core, N = N workers
+_EMBED_PARALLEL_RAW = os.getenv("EMBED_PARALLEL", "").strip()
+EMBED_PARALLEL = int(_EMBED_PARALLEL_RAW) if _EMBED_PARALLEL_RAW else None
 
 ENABLE_VLM_CAPTIONS = os.getenv("ENABLE_VLM_CAPTIONS", "0").strip() == "1"
 CAPTION_MAX_PAGES = int(os.getenv("CAPTION_MAX_PAGES", "0"))      # 0 = unlimited
 CAPTION_MIN_IMAGE_COUNT = int(os.getenv("CAPTION_MIN_IMAGE_COUNT", "1"))
 CAPTION_MIN_DRAWING_COUNT = int(os.getenv("CAPTION_MIN_DRAWING_COUNT", "1"))
 CAPTION_DPI = int(os.getenv("CAPTION_DPI", "150"))
+# Page images sent to the VLM: longest side capped at CAPTION_MAX_PX (the VLM
+# downsamples anyway) and JPEG-encoded, a fraction of the PNG payload size.
+CAPTION_MAX_PX = int(os.getenv("CAPTION_MAX_PX", "1600"))   # 0 = no cap
+CAPTION_IMAGE_FORMAT = os.getenv("CAPTION_IMAGE_FORMAT", "jpg").strip().lower()  # jpg | png
+CAPTION_JPEG_QUALITY = int(os.getenv("CAPTION_JPEG_QUALITY", "85"))
 
 # Candidate detection toggles
 CAPTION_USE_DRAWINGS = os.getenv("CAPTION_USE_DRAWINGS", "1").strip() == "1"
@@ -35,32 +57,58 @@ RESET_COLLECTION = os.getenv("RESET_COLLECTION", "0").strip() == "1"
 # Text cues: generic + bilingual-ish (not model-dependent, only our detector)
 DEFAULT_CUE_REGEX = r"(diagram|figure|table|chart|flowchart|illustration|example below|in the diagram|see (the )?diagram|şekil|tablo|aşağıdaki|örnek|bkz)"
 CAPTION_TEXT_CUE_REGEX = os.getenv("CAPTION_TEXT_CUE_REGEX", DEFAULT_CUE_REGEX)
-_CUE_RE = re.compile(CAPTION_TEXT_CUE_REGEX, re.IGNORECASE)
+
+
+def _fold_cue_text(s: str) -> str:
+    # re.IGNORECASE treats i/I/ı/İ as one letter; str.lower() alone doesn't
+    # ("İ" -> "i̇", "ı" stays), so fold them the same way
+    return s.lower().replace("i\u0307", "i").replace("ı", "i")
+
+
+# The default cues are all literals, so a lowercase substring scan does the same
+# job as the regex ("flowchart"/"in the diagram"/"see (the )?diagram" are covered
+# by "chart"/"diagram"). A custom CAPTION_TEXT_CUE_REGEX still goes through re.
+_CUE_LITERALS = tuple(_fold_cue_text(k) for k in (
+    "diagram", "figure", "table", "chart", "illustration", "example below",
+    "şekil", "tablo", "aşağıdaki", "örnek", "bkz",
+))
+_CUE_RE = (
+    re.compile(CAPTION_TEXT_CUE_REGEX, re.IGNORECASE)
+    if CAPTION_TEXT_CUE_REGEX != DEFAULT_CUE_REGEX
+    else None
+)
 
 # Optional: infer a rough "section" label from page text (helps class questions)
 CLASS_IN_TEXT_RE = re.compile(r"\bClass\s+([A-Z])\b", re.IGNORECASE)
 
 
-def extract_pages_text(pdf_path: Path) -> List[Dict[str, Any]]:
-    reader = PdfReader(str(pdf_path))
+def extract_pages_text(doc: fitz.Document) -> List[Dict[str, Any]]:
+    # MuPDF does the text extraction natively (process_pdf_captions also renders
+    # from the same open document)
     pages = []
-    for i, page in enumerate(reader.pages):
-        text = page.extract_text() or ""
+    for i, page in enumerate(doc):
+        text = page.get_text("text") or ""
         text = " ".join(text.split())
         pages.append({"page": i + 1, "text": text})
     return pages
 
 
+def _chunk_bounds(n: int, chunk_size: int, overlap: int) -> range:
+    """Start offsets of the chunk windows over a text of length n (each window is chunk_size long)."""
+    # Windows start every (chunk_size - overlap) chars; the last one is the first
+    # that reaches the end of the text. Computed up front instead of stepping a loop.
+    if not n:
+        return range(0)
+    step = chunk_size - overlap
+    if step <= 0:
+        raise ValueError("chunk_size must be larger than overlap")
+    last = max(0, -(-(n - chunk_size) // step))  # ceil((n - chunk_size) / step)
+    return range(0, last * step + 1, step)
+
+
 def chunk_text(text: str, chunk_size: int = 1200, overlap: int = 150) -> List[str]:
-    chunks = []
-    start = 0
-    while start < len(text):
-        end = min(len(text), start + chunk_size)
-        chunks.append(text[start:end])
-        if end == len(text):
-            break
-        start = max(0, end - overlap)
-    return chunks
+    # slicing clamps the last window at len(text)
+    return [text[start : start + chunk_size] for start in _chunk_bounds(len(text), chunk_size, overlap)]
 
 
 def page_image_count(page: fitz.Page) -> int:
@@ -87,20 +135,143 @@ def infer_section_from_text(page_text: str) -> Optional[str]:
     return None
 
 
+def has_text_cue(page_text: str) -> bool:
+    if not page_text:
+        return False
+    if _CUE_RE is not None:
+        return bool(_CUE_RE.search(page_text))
+    t = _fold_cue_text(page_text)
+    return any(k in t for k in _CUE_LITERALS)
+
+
 def is_visual_candidate(page: fitz.Page, page_text: str) -> Tuple[bool, Dict[str, Any]]:
     img_n = page_image_count(page)
     drw_n = page_drawing_count(page) if CAPTION_USE_DRAWINGS else 0
-    cue_hit = bool(_CUE_RE.search(page_text or "")) if CAPTION_USE_TEXT_CUES else False
+    cue_hit = has_text_cue(page_text) if CAPTION_USE_TEXT_CUES else False
 
     ok = (img_n >= CAPTION_MIN_IMAGE_COUNT) or (drw_n >= CAPTION_MIN_DRAWING_COUNT) or cue_hit
     meta = {"images": img_n, "drawings": drw_n, "cue_hit": cue_hit}
     return ok, meta
 
 
-def render_page_png(page: fitz.Page, dpi: int = 150) -> bytes:
-    mat = fitz.Matrix(dpi / 72.0, dpi / 72.0)
-    pix = page.get_pixmap(matrix=mat, alpha=False)
-    return pix.tobytes("png")
+def render_page_image(page: fitz.Page, dpi: int = 150) -> bytes:
+    zoom = dpi / 72.0
+    if CAPTION_MAX_PX:
+        # lower the zoom up front instead of rendering big and shrinking afterwards
+        longest = max(page.rect.width, page.rect.height)
+        if longest * zoom > CAPTION_MAX_PX:
+            zoom = CAPTION_MAX_PX / longest
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+    if CAPTION_IMAGE_FORMAT == "png":
+        return pix.tobytes("png")
+    return pix.tobytes("jpg", jpg_quality=CAPTION_JPEG_QUALITY)
+
+
+def embed_documents(embedder: TextEmbedding, docs: List[str]) -> List[Any]:
+    # Identical chunks (repeated headers/footers/boilerplate) are embedded once and
+    # their vector shared; the text itself is the dict key.
+    slot_of: Dict[str, int] = {}
+    slots = [slot_of.setdefault(d, len(slot_of)) for d in docs]
+    unique = list(slot_of)
+
+    # Longest first, so each batch holds similar lengths (less padding per batch);
+    # vectors are put back in the original docs order.
+    order = sorted(range(len(unique)), key=lambda i: len(unique[i]), reverse=True)
+    embedded = embedder.embed(
+        [unique[i] for i in order],
+        batch_size=EMBED_BATCH_SIZE,
+        parallel=EMBED_PARALLEL,
+    )
+    unique_vectors: List[Any] = [None] * len(unique)
+    for i, vec in zip(order, embedded):
+        unique_vectors[i] = vec
+    return [unique_vectors[j] for j in slots]
+
+
+def _manifest_path() -> Path:
+    return Path(CHROMA_PATH) / f"ingested_ids.{COLLECTION_NAME}.json"
+
+
+def load_manifest(collection: chromadb.Collection) -> Set[str]:
+    """Ids already written to this collection by earlier runs (local, no Chroma query)."""
+    if RESET_COLLECTION:
+        return set()
+    try:
+        data = json.loads(_manifest_path().read_text(encoding="utf-8"))
+        # the manifest records the collection size it was written against; if the
+        # store was emptied, rebuilt or replaced since, it can't be trusted
+        if data.get("count") != collection.count():
+            print("[CHROMA] Id manifest is stale (collection count changed), ignoring it.", flush=True)
+            return set()
+        return set(data.get("ids") or [])
+    except Exception:
+        return set()
+
+
+def save_manifest(manifest: Set[str], collection: chromadb.Collection) -> None:
+    path = _manifest_path()
+    tmp = path.with_suffix(".json.tmp")
+    try:
+        data = {"count": collection.count(), "ids": sorted(manifest)}
+        tmp.write_text(json.dumps(data), encoding="utf-8")
+        os.replace(tmp, path)
+    except Exception as e:
+        print(f"[CHROMA] Could not write id manifest {path}: {e}", flush=True)
+
+
+def flush_chunks(
+    collection: chromadb.Collection,
+    embedder: TextEmbedding,
+    ids: List[str],
+    docs: List[str],
+    metadatas: List[Dict[str, Any]],
+    manifest: Set[str],
+) -> Tuple[int, int]:
+    """Embed + add one batch of chunks; returns (text chunks added, caption chunks added)."""
+    if not ids:
+        return 0, 0
+
+    # If collection not reset, avoid spam by filtering ids already present
+    # (before embedding, so existing chunks aren't embedded again). Ids in the local
+    # manifest are skipped outright; Chroma is only asked about the rest (e.g. a DB
+    # built before the manifest existed).
+    if not RESET_COLLECTION:
+        existing = {_id for _id in ids if _id in manifest}
+        unknown = [_id for _id in ids if _id not in existing]
+        if unknown:
+            try:
+                # light check: only fetch ids we are about to insert
+                # chroma get can accept ids list; if some are missing it returns those found
+                got = collection.get(ids=unknown, include=[])
+                for _id in (got.get("ids") or []):
+                    if isinstance(_id, str):
+                        existing.add(_id)
+                        manifest.add(_id)
+            except Exception:
+                pass
+
+        if existing:
+            keep = [i for i, _id in enumerate(ids) if _id not in existing]
+            ids = [ids[i] for i in keep]
+            docs = [docs[i] for i in keep]
+            metadatas = [metadatas[i] for i in keep]
+            print(f"[CHROMA] Skipping {len(existing)} already-existing ids.", flush=True)
+
+    if not docs:
+        save_manifest(manifest, collection)
+        return 0, 0
+
+    print(f"[EMBED] Embedding {len(docs)} chunks...", flush=True)
+    vectors = embed_documents(embedder, docs)
+
+    print(f"[CHROMA] Writing {len(docs)} chunks to collection={COLLECTION_NAME} ...", flush=True)
+    collection.add(ids=ids, documents=docs, embeddings=vectors, metadatas=metadatas)
+    manifest.update(ids)
+    save_manifest(manifest, collection)
+
+    text_count = sum(1 for m in metadatas if m.get("kind") == "text")
+    cap_count = sum(1 for m in metadatas if m.get("kind") == "caption")
+    return text_count, cap_count
 
 
 def _get_or_reset_collection(client: chromadb.PersistentClient) -> chromadb.Collection:
@@ -110,75 +281,124 @@ def _get_or_reset_collection(client: chromadb.PersistentClient) -> chromadb.Coll
             print(f"[CHROMA] Deleted collection={COLLECTION_NAME} (RESET_COLLECTION=1)", flush=True)
         except Exception:
             pass
-    return client.get_or_create_collection(name=COLLECTION_NAME)
+    return client.get_or_create_collection(name=COLLECTION_NAME, metadata={"hnsw:space": CHROMA_SPACE})
 
 
-def main():
-    pdfs = sorted(DATA_DIR.glob("*.pdf"))
-    if not pdfs:
-        raise SystemExit(f"No PDFs found in {DATA_DIR}. Add a PDF and re-run.")
-
-    print(f"[INGEST] CHROMA_PATH={CHROMA_PATH} COLLECTION={COLLECTION_NAME}")
-    print(f"[INGEST] EMBED_MODEL={EMBED_MODEL}")
-    print(f"[INGEST] RESET_COLLECTION={RESET_COLLECTION}")
-    print(f"[INGEST] ENABLE_VLM_CAPTIONS={ENABLE_VLM_CAPTIONS}")
-    if ENABLE_VLM_CAPTIONS:
-        print(f"[INGEST] CAPTION_DPI={CAPTION_DPI}")
-        print(f"[INGEST] CAPTION_MIN_IMAGE_COUNT={CAPTION_MIN_IMAGE_COUNT} CAPTION_MIN_DRAWING_COUNT={CAPTION_MIN_DRAWING_COUNT}")
-        print(f"[INGEST] CAPTION_USE_DRAWINGS={CAPTION_USE_DRAWINGS} CAPTION_USE_TEXT_CUES={CAPTION_USE_TEXT_CUES}")
-        print(f"[INGEST] CAPTION_TEXT_CUE_REGEX={CAPTION_TEXT_CUE_REGEX}")
-        print(f"[INGEST] CAPTION_MAX_PAGES={CAPTION_MAX_PAGES}")
-        print(f"[INGEST] VLM_MODEL={os.getenv('OLLAMA_VLM_MODEL','llava:13b')} VLM_MIN_CONFIDENCE={os.getenv('VLM_MIN_CONFIDENCE','0.60')}")
-    print("", flush=True)
+def process_pdf_text(
+    pdf_path: Path,
+) -> Tuple[List[str], List[str], List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Text chunks of one PDF: (ids, docs, metadatas, pages); pages go to the caption task."""
+    ids: List[str] = []
+    docs: List[str] = []
+    metadatas: List[Dict[str, Any]] = []
 
-    client = chromadb.PersistentClient(path=CHROMA_PATH)
-    collection = _get_or_reset_collection(client)
-    embedder = TextEmbedding(model_name=EMBED_MODEL)
+    print(f"[PDF] Processing: {pdf_path.name}", flush=True)
 
+    doc = fitz.open(str(pdf_path))
+    try:
+        pages = extract_pages_text(doc)
+    finally:
+        doc.close()
+
+    # ---- TEXT CHUNKS ----
+    text_added = 0
+    for p in pages:
+        page_no = p["page"]
+        text = (p["text"] or "").strip()
+        if not text:
+            continue
+
+        section = infer_section_from_text(text)
+
+        for ci, chunk in enumerate(chunk_text(text)):
+            doc_id = f"{pdf_path.stem}_p{page_no}_text_c{ci}"
+            ids.append(doc_id)
+            docs.append(chunk)
+            md = {
+                "filename": pdf_path.name,
+                "page": page_no,
+                "kind": "text",
+            }
+            if section:
+                md["section"] = section
+            metadatas.append(md)
+            text_added += 1
+
+    print(f"[PDF] Text chunks added: {text_added}", flush=True)
+    return ids, docs, metadatas, pages
+
+
+def process_pdf_captions(
+    pdf_path: Path, pages: List[Dict[str, Any]]
+) -> Tuple[List[str], List[str], List[Dict[str, Any]]]:
+    """VLM caption chunks of one PDF's visual pages: (ids, docs, metadatas).
+
+    `pages` is the text extracted by process_pdf_text, so the PDF is only opened
+    here to render the candidate pages.
+    """
     ids: List[str] = []
     docs: List[str] = []
     metadatas: List[Dict[str, Any]] = []
 
-    for pdf_path in pdfs:
-        print(f"[PDF] Processing: {pdf_path.name}", flush=True)
-
-        pages = extract_pages_text(pdf_path)
+    # ---- CAPTIONS ----
+    cap_added = 0
+    doc = fitz.open(str(pdf_path))
+    try:
         page_text_map = {p["page"]: (p.get("text") or "") for p in pages}
+        total_pages = doc.page_count
+
+        # Pages are rendered here one by one (MuPDF isn't thread-safe) while up to
+        # VLM_CONCURRENCY caption requests are in flight; results are taken in page
+        # order, so CAPTION_MAX_PAGES keeps the first accepted pages as before.
+        pending: Deque[Tuple[int, str, Dict[str, Any], Future]] = deque()
+
+        def collect() -> None:
+            nonlocal cap_added
+            page_no, page_text, cand_meta, fut = pending.popleft()
+            if CAPTION_MAX_PAGES and cap_added >= CAPTION_MAX_PAGES:
+                fut.cancel()
+                return
+            try:
+                cap, dbg = fut.result()
+            except Exception as e:
+                print(f"[VLM] ERROR {pdf_path.name} page={page_no}: {e}", flush=True)
+                return
+
+            print(
+                f"[VLM] {pdf_path.name} page={page_no} "
+                f"conf={dbg.get('confidence',0):.2f} reason={dbg.get('reason')} latency={dbg.get('latency_s')}s",
+                flush=True,
+            )
+
+            if cap:
+                section = infer_section_from_text(page_text)
+                cap_id = f"{pdf_path.stem}_p{page_no}_caption_c0"
+                ids.append(cap_id)
+                docs.append("FIGURE/TABLE CAPTION:\n" + cap)
 
-        # ---- TEXT CHUNKS ----
-        text_added = 0
-        for p in pages:
-            page_no = p["page"]
-            text = (p["text"] or "").strip()
-            if not text:
-                continue
-
-            section = infer_section_from_text(text)
-
-            for ci, chunk in enumerate(chunk_text(text)):
-                doc_id = f"{pdf_path.stem}_p{page_no}_text_c{ci}"
-                ids.append(doc_id)
-                docs.append(chunk)
                 md = {
                     "filename": pdf_path.name,
                     "page": page_no,
-                    "kind": "text",
+                    "kind": "caption",
+                    "vlm_model": dbg.get("vlm_model"),
+                    "vlm_confidence": dbg.get("confidence"),
+                    "cand_images": cand_meta["images"],
+                    "cand_drawings": cand_meta["drawings"],
+                    "cand_cue_hit": cand_meta["cue_hit"],
                 }
                 if section:
                     md["section"] = section
                 metadatas.append(md)
-                text_added += 1
 
-        print(f"[PDF] Text chunks added: {text_added}", flush=True)
-
-        # ---- CAPTIONS ----
-        cap_added = 0
-        if ENABLE_VLM_CAPTIONS:
-            doc = fitz.open(str(pdf_path))
-            total_pages = doc.page_count
-            caption_pages_done = 0
+                cap_added += 1
+                if CAPTION_MAX_PAGES and cap_added >= CAPTION_MAX_PAGES:
+                    print(f"[CAPTION] Reached CAPTION_MAX_PAGES={CAPTION_MAX_PAGES}.", flush=True)
 
+        with ThreadPoolExecutor(max_workers=VLM_CONCURRENCY) as vlm_pool:
             for page_index in range(total_pages):
+                if CAPTION_MAX_PAGES and cap_added >= CAPTION_MAX_PAGES:
+                    break
+
                 page_no = page_index + 1
                 page = doc.load_page(page_index)
                 page_text = page_text_map.get(page_no, "") or ""
@@ -194,98 +414,130 @@ def main():
                 )
 
                 try:
-                    png = render_page_png(page, dpi=CAPTION_DPI)
-                    cap, dbg = caption_image(
-                        png,
-                        pdf_name=pdf_path.name,
-                        page_no=page_no,
-                        page_text_hint=page_text,
-                    )
+                    image = render_page_image(page, dpi=CAPTION_DPI)
                 except Exception as e:
                     print(f"[VLM] ERROR {pdf_path.name} page={page_no}: {e}", flush=True)
                     continue
 
-                print(
-                    f"[VLM] {pdf_path.name} page={page_no} "
-                    f"conf={dbg.get('confidence',0):.2f} reason={dbg.get('reason')} latency={dbg.get('latency_s')}s",
-                    flush=True,
+                fut = vlm_pool.submit(
+                    caption_image,
+                    image,
+                    pdf_name=pdf_path.name,
+                    page_no=page_no,
+                    page_text_hint=page_text,
                 )
+                pending.append((page_no, page_text, cand_meta, fut))
+                if len(pending) >= VLM_CONCURRENCY:
+                    collect()
 
-                if cap:
-                    section = infer_section_from_text(page_text)
-                    cap_id = f"{pdf_path.stem}_p{page_no}_caption_c0"
-                    ids.append(cap_id)
-                    docs.append("FIGURE/TABLE CAPTION:\n" + cap)
-
-                    md = {
-                        "filename": pdf_path.name,
-                        "page": page_no,
-                        "kind": "caption",
-                        "vlm_model": dbg.get("vlm_model"),
-                        "vlm_confidence": dbg.get("confidence"),
-                        "cand_images": cand_meta["images"],
-                        "cand_drawings": cand_meta["drawings"],
-                        "cand_cue_hit": cand_meta["cue_hit"],
-                    }
-                    if section:
-                        md["section"] = section
-                    metadatas.append(md)
-
-                    cap_added += 1
-                    caption_pages_done += 1
-
-                if CAPTION_MAX_PAGES and caption_pages_done >= CAPTION_MAX_PAGES:
-                    print(f"[CAPTION] Reached CAPTION_MAX_PAGES={CAPTION_MAX_PAGES}.", flush=True)
-                    break
+            while pending:
+                collect()
+    finally:
+        doc.close()
 
-            doc.close()
+    print(f"[PDF] Caption chunks added: {cap_added} ({pdf_path.name})\n", flush=True)
+    return ids, docs, metadatas
 
-        print(f"[PDF] Caption chunks added: {cap_added}\n", flush=True)
 
-    if not docs:
-        raise SystemExit("No content extracted.")
+def main():
+    pdfs = sorted(DATA_DIR.glob("*.pdf"))
+    if not pdfs:
+        raise SystemExit(f"No PDFs found in {DATA_DIR}. Add a PDF and re-run.")
 
-    print(f"[EMBED] Embedding {len(docs)} chunks...", flush=True)
-    vectors = list(embedder.embed(docs))
+    print(f"[INGEST] CHROMA_PATH={CHROMA_PATH} COLLECTION={COLLECTION_NAME}")
+    print(f"[INGEST] EMBED_MODEL={EMBED_MODEL} EMBED_BATCH_SIZE={EMBED_BATCH_SIZE} EMBED_PARALLEL={EMBED_PARALLEL}")
+    print(f"[INGEST] RESET_COLLECTION={RESET_COLLECTION} CHROMA_SPACE={CHROMA_SPACE}")
+    print(f"[INGEST] ENABLE_VLM_CAPTIONS={ENABLE_VLM_CAPTIONS}")
+    if ENABLE_VLM_CAPTIONS:
+        print(f"[INGEST] CAPTION_DPI={CAPTION_DPI} CAPTION_MAX_PX={CAPTION_MAX_PX} CAPTION_IMAGE_FORMAT={CAPTION_IMAGE_FORMAT}")
+        print(f"[INGEST] CAPTION_MIN_IMAGE_COUNT={CAPTION_MIN_IMAGE_COUNT} CAPTION_MIN_DRAWING_COUNT={CAPTION_MIN_DRAWING_COUNT}")
+        print(f"[INGEST] CAPTION_USE_DRAWINGS={CAPTION_USE_DRAWINGS} CAPTION_USE_TEXT_CUES={CAPTION_USE_TEXT_CUES}")
+        print(f"[INGEST] CAPTION_TEXT_CUE_REGEX={CAPTION_TEXT_CUE_REGEX}")
+        print(f"[INGEST] CAPTION_MAX_PAGES={CAPTION_MAX_PAGES} VLM_CONCURRENCY={VLM_CONCURRENCY}")
+        print(f"[INGEST] VLM_MODEL={os.getenv('OLLAMA_VLM_MODEL','llava:13b')} VLM_MIN_CONFIDENCE={os.getenv('VLM_MIN_CONFIDENCE','0.60')}")
+    print("", flush=True)
 
-    print(f"[CHROMA] Writing {len(docs)} chunks to collection={COLLECTION_NAME} ...", flush=True)
+    client = chromadb.PersistentClient(path=CHROMA_PATH)
+    collection = _get_or_reset_collection(client)
+    manifest = load_manifest(collection)
+    embedder = TextEmbedding(model_name=EMBED_MODEL)
 
-    # If collection not reset, avoid spam by filtering ids already present
-    if not RESET_COLLECTION:
-        try:
-            existing = set()
-            # light check: only fetch ids we are about to insert
-            # chroma get can accept ids list; if some are missing it returns those found
-            got = collection.get(ids=ids, include=[])
-            for _id in (got.get("ids") or []):
-                if isinstance(_id, str):
-                    existing.add(_id)
-
-            if existing:
-                keep_ids, keep_docs, keep_vecs, keep_metas = [], [], [], []
-                for i, _id in enumerate(ids):
-                    if _id in existing:
-                        continue
-                    keep_ids.append(_id)
-                    keep_docs.append(docs[i])
-                    keep_vecs.append(vectors[i])
-                    keep_metas.append(metadatas[i])
-
-                ids, docs, vectors, metadatas = keep_ids, keep_docs, keep_vecs, keep_metas
-                print(f"[CHROMA] Skipping {len(existing)} already-existing ids.", flush=True)
-        except Exception:
-            pass
+    ids: List[str] = []
+    docs: List[str] = []
+    metadatas: List[Dict[str, Any]] = []
+    extracted = 0
+    text_count = 0
+    cap_count = 0
+
+    def flush() -> None:
+        nonlocal text_count, cap_count
+        t, c = flush_chunks(collection, embedder, ids, docs, metadatas, manifest)
+        text_count += t
+        cap_count += c
+        ids.clear()
+        docs.clear()
+        metadatas.clear()
+
+    def add(pdf_ids: List[str], pdf_docs: List[str], pdf_metas: List[Dict[str, Any]]) -> None:
+        nonlocal extracted
+        ids.extend(pdf_ids)
+        docs.extend(pdf_docs)
+        metadatas.extend(pdf_metas)
+        extracted += len(pdf_ids)
+        if len(ids) >= INGEST_FLUSH_SIZE:
+            flush()
+
+    # PDFs are parsed (and captioned) in worker processes. Each PDF's caption task
+    # is queued as soon as its text task returns (reusing the extracted page text),
+    # and all text chunks are embedded/written here before the first caption result
+    # is awaited, so embedding overlaps the VLM calls whatever the corpus size.
+    n_tasks = len(pdfs) * (2 if ENABLE_VLM_CAPTIONS else 1)
+    workers = max(1, min(INGEST_WORKERS, n_tasks))
+    pool = None
+    if workers > 1:
+        # spawn: don't fork a parent that already runs ONNX Runtime/Chroma threads
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
 
-    if not docs:
-        print("[CHROMA] Nothing new to add (all ids existed).", flush=True)
-        return
+    try:
+        if pool is not None:
+            text_futures = [pool.submit(process_pdf_text, p) for p in pdfs]
+            text_results = (f.result() for f in text_futures)
+        else:
+            text_results = (process_pdf_text(p) for p in pdfs)
+
+        caption_futures: List[Future] = []
+        caption_inputs: List[Tuple[Path, List[Dict[str, Any]]]] = []
+        for pdf_path, (pdf_ids, pdf_docs, pdf_metas, pages) in zip(pdfs, text_results):
+            if ENABLE_VLM_CAPTIONS:
+                if pool is not None:
+                    caption_futures.append(pool.submit(process_pdf_captions, pdf_path, pages))
+                else:
+                    caption_inputs.append((pdf_path, pages))
+            add(pdf_ids, pdf_docs, pdf_metas)
+
+        # text is done: write it now instead of waiting for INGEST_FLUSH_SIZE
+        flush()
+
+        if pool is not None:
+            caption_results = (f.result() for f in caption_futures)
+        else:
+            caption_results = (process_pdf_captions(p, pages) for p, pages in caption_inputs)
+        for pdf_ids, pdf_docs, pdf_metas in caption_results:
+            add(pdf_ids, pdf_docs, pdf_metas)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+    if not extracted:
+        raise SystemExit("No content extracted.")
 
-    collection.add(ids=ids, documents=docs, embeddings=vectors, metadatas=metadatas)
+    flush()
 
-    text_count = sum(1 for m in metadatas if m.get("kind") == "text")
-    cap_count = sum(1 for m in metadatas if m.get("kind") == "caption")
+    if not (text_count or cap_count):
+        print("[CHROMA] Nothing new to add (all ids existed).", flush=True)
+        return
 
-    print(f"\n✅ Ingested {len(docs)} chunks into Chroma at {CHROMA_PATH}, collection={COLLECTION_NAME}")
+    print(f"\n✅ Ingested {text_count + cap_count} chunks into Chroma at {CHROMA_PATH}, collection={COLLECTION_NAME}")
     print(f"   - text chunks: {text_count}")
     print(f"   - caption chunks: {cap_count}")
     print(f"   - ENABLE_VLM_CAPTIONS={ENABLE_VLM_CAPTIONS}")
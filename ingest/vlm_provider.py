@@ -1,10 +1,13 @@
 import os
-import json
+import atexit
 import time
 import base64
+import hashlib
+from pathlib import Path
 from typing import Any, Dict, Optional, Tuple, List
 
 import httpx
+import orjson
 
 
 class VLMError(RuntimeError):
@@ -39,16 +42,62 @@ def _normalize_blacklist() -> List[str]:
     return [p.strip().lower() for p in raw.split("|") if p.strip()]
 
 
+# parsed once at import; captions are checked once per page
+_BLACKLIST = tuple(_normalize_blacklist())
+
+
 def _matches_blacklist(text: str) -> bool:
     t = (text or "").lower()
-    for term in _normalize_blacklist():
-        if term and term in t:
-            return True
-    return False
+    return any(term in t for term in _BLACKLIST)
+
+
+# One keep-alive connection pool per (worker) process instead of a new connection
+# per page; closed at interpreter exit. Built eagerly at import (no I/O) because
+# caption_image runs on VLM_CONCURRENCY threads, and a lazy check-and-create there
+# could build (and leak) a second pool.
+_VLM_CLIENT = httpx.Client(
+    limits=httpx.Limits(max_keepalive_connections=4, keepalive_expiry=300),
+)
+atexit.register(_VLM_CLIENT.close)
+
+
+def _vlm_client() -> httpx.Client:
+    return _VLM_CLIENT
+
+
+# Raw VLM responses cached on disk, keyed by image bytes + request (model, prompt,
+# options), so re-ingesting unchanged pages skips the model call. Acceptance rules
+# (confidence, blacklist, length) are re-applied to cached responses.
+VLM_CACHE = os.getenv("VLM_CACHE", "1").strip() == "1"
+VLM_CACHE_DIR = Path(os.getenv("VLM_CACHE_DIR", str(Path(__file__).resolve().parents[1] / ".vlm_cache")))
+
+
+def _cache_key(image_bytes: bytes, request: Dict[str, Any]) -> str:
+    h = hashlib.blake2b(image_bytes, digest_size=16)
+    h.update(orjson.dumps(request, option=orjson.OPT_SORT_KEYS))
+    return h.hexdigest()
+
+
+def _cache_get(key: str) -> Optional[str]:
+    try:
+        return (VLM_CACHE_DIR / f"{key}.json").read_text(encoding="utf-8")
+    except OSError:
+        return None
+
+
+def _cache_put(key: str, raw: str) -> None:
+    try:
+        VLM_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        path = VLM_CACHE_DIR / f"{key}.json"
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        tmp.write_text(raw, encoding="utf-8")
+        os.replace(tmp, path)
+    except OSError:
+        pass
 
 
 def caption_image(
-    png_bytes: bytes,
+    image_bytes: bytes,
     *,
     pdf_name: str,
     page_no: int,
@@ -67,7 +116,6 @@ def caption_image(
     num_predict = _env_int("VLM_NUM_PREDICT", 220)
 
     url = f"{base}/api/generate"
-    b64 = base64.b64encode(png_bytes).decode("utf-8")
 
     hint = ""
     if page_text_hint:
@@ -99,24 +147,31 @@ def caption_image(
         + (f"TEXT_HINT (may help align labels): {hint}\n" if hint else "")
     )
 
-    payload = {
+    request = {
         "model": model,
         "prompt": prompt,
-        "images": [b64],
         "stream": False,
         "format": "json",
         "options": {"temperature": temperature, "num_predict": num_predict},
     }
 
+    cache_key = _cache_key(image_bytes, request) if VLM_CACHE else None
+    raw = _cache_get(cache_key) if cache_key else None
+    cached = raw is not None
+
     t0 = time.time()
-    try:
-        r = httpx.post(url, json=payload, timeout=timeout_s)
-        r.raise_for_status()
-    except Exception as e:
-        raise VLMError(f"VLM request failed: {e}") from e
+    if raw is None:
+        # PNG or JPEG: Ollama sniffs the format from the bytes
+        payload = {**request, "images": [base64.b64encode(image_bytes).decode("ascii")]}
+        try:
+            r = _vlm_client().post(url, json=payload, timeout=timeout_s)
+            r.raise_for_status()
+        except Exception as e:
+            raise VLMError(f"VLM request failed: {e}") from e
+
+        raw = (orjson.loads(r.content).get("response") or "").strip()
     dt = time.time() - t0
 
-    raw = (r.json().get("response") or "").strip()
     candidate = _extract_json_block(raw)
 
     debug: Dict[str, Any] = {
@@ -124,6 +179,7 @@ def caption_image(
         "page": page_no,
         "vlm_model": model,
         "latency_s": round(dt, 2),
+        "cached": cached,
         "raw_json": candidate,
         "reason": "",
         "confidence": 0.0,
@@ -132,11 +188,15 @@ def caption_image(
     }
 
     try:
-        parsed = json.loads(candidate)
+        parsed = orjson.loads(candidate)
     except Exception:
+        # not cached: a one-off bad reply is retried on the next ingest
         debug["reason"] = "invalid_json"
         return None, debug
 
+    if cache_key and not cached and isinstance(parsed, dict):
+        _cache_put(cache_key, raw)
+
     has_figure = bool(parsed.get("has_figure", False))
     conf = parsed.get("confidence", 0.0)
     try: